@@ -10,19 +10,32 @@ Created by: Rui Carmo
 """
 
 import os, sys, time, logging
-from fabric.api import env, local, hosts, roles, execute
+from fabric.api import env, local, hosts, roles, execute, cd
 from fabric.operations import run, sudo, put, hide, settings
-from fabric.contrib.files import contains, exists, cd, append, comment
+from fabric.contrib.files import contains, exists, append, comment
 from fabric.contrib.project import rsync_project
 from StringIO import StringIO
 
-from .config import repos, packages, tarballs
+from .config import repos, packages, tarballs, configuration_files, apt_bundle
 from .helpers import tarball, psql, collect_ip_addresses, inject_files
-from .debian import setup_repo, install, pip_install
-from .postgres import rebind_postgres, setup_database, setup_master, setup_slaves
-from .redis import rebind_redis, lockdown_redis
+from .debian import setup_repo, install, install_packages, apt_update
+from .postgres import rebind_postgres, setup_database, setup_master, setup_slaves, show_tuning, rsync_data
+from .pgbouncer import setup_pgbouncer, reload_pgbouncer
+from .redis import rebind_redis, lockdown_redis, tune_redis, verify_redis, setup_sentinel, redis_topology, local_redis
+from .redis import create_redis_cluster, rebalance_redis_cluster, redis_slots, local_redis_cluster
 from .solr import unpack_solr, setup_solr_service, setup_solr_master, setup_solr_slave, upload_solr_collection
-from .zookeeper import unpack_zookeeper, setup_zookeeper_service
+from .solr import plan_solr, local_solr_plan
+from .reindex import reindex_solr
+from .zookeeper import unpack_zookeeper, setup_zookeeper_service, measure_latency, zookeeper_health
+from .aptbundle import build_apt_bundle, install_apt_bundle
+from .wheelhouse import build_wheelhouse, install_wheelhouse
+from .project import deploy_project, rollback_project
+from .benchmark import benchmark, set_baseline
+from .facts import gather_facts, invalidate_facts
+from .handlers import flush_handlers
+from .artifacts import distribute_artifacts
+from .rollout import rollout
+from .trace import instrument
 
 
 # We assume we'll have 3 boxes in production, one master and two slaves
@@ -33,6 +46,10 @@ env.roledefs = {
     'slaves'      : ['box2', 'box3']
 }
 env.addresses = {}
+env.facts = {}
+env.latency = {}
+
+instrument()
 
 
 # Test our local (Python) app
@@ -40,56 +57,106 @@ def test():
     local("nosetests")
 
 
-# Deploy our shared redis, re-binding it to the network interfaces and locking it down with a password
+# Each cluster task is a list of (task, hosts) steps run by the rollout engine,
+# which fans out whatever is safe to run on all boxes at once
+# with the APT bundle enabled every box installs from a copy of what the master downloaded
+apt_steps = [
+    (build_apt_bundle,        None),
+    (install_apt_bundle,      'production'),
+] if apt_bundle['enabled'] else []
+
+python_steps = [
+    (build_wheelhouse,        None),
+    (install_wheelhouse,      'production'),
+]
+
+redis_steps = [
+    (collect_ip_addresses,    'production'),
+    (rebind_redis,            'production'),
+    (lockdown_redis,          'production'),
+    (tune_redis,              'production'),
+    (setup_sentinel,          'production'),
+    (create_redis_cluster,    'master'),
+]
+
+postgres_steps = [
+    (collect_ip_addresses,    'production'),
+    (rebind_postgres,         'production'),
+    (setup_database,          'production'),
+    (setup_master,            'master'),
+    # slaves need the master's new replication settings live before they can seed
+    (flush_handlers,          'master'),
+    (setup_slaves,            'slaves'),
+]
+
+pgbouncer_steps = [
+    (collect_ip_addresses,    'production'),
+    (setup_pgbouncer,         'production'),
+]
+
+solr_steps = [
+    (collect_ip_addresses,    'production'),
+    (distribute_artifacts,    None, {'names': ['solr']}),
+    (unpack_solr,             'production'),
+    (setup_solr_service,      'production'),
+    (setup_solr_master,       'master'),
+    (setup_solr_slave,        'slaves'),
+]
+
+zookeeper_steps = [
+    (collect_ip_addresses,    'production'),
+    (distribute_artifacts,    None, {'names': ['zookeeper']}),
+    (unpack_zookeeper,        'production'),
+    (measure_latency,         'production'),
+    (setup_zookeeper_service, 'production'),
+]
+
+
+# Deploy our shared redis as a primary on the master with replicas on the slaves and a Sentinel
+# on every box, re-binding it to the network interfaces and locking it down with a password
 def shared_redis():
-    execute(collect_ip_addresses,hosts=env.roledefs['production'])
-    execute(rebind_redis)
-    execute(lockdown_redis)
+    rollout(redis_steps)
 
 
 # Deploy our postgres cluster, re-binding the network interfaces too
 def postgres_cluster():
-    execute(collect_ip_addresses,hosts=env.roledefs['production'])
-    execute(rebind_postgres)
-    execute(setup_database, hosts=env.roledefs['production'])
-    execute(setup_master,   hosts=env.roledefs['master'])
-    execute(setup_slaves,   hosts=env.roledefs['slaves'])
-    
+    rollout(postgres_steps)
+
+
+# Put pgbouncer in front of the postgres cluster on every box
+def connection_pooling():
+    rollout(pgbouncer_steps)
+
 
 # Deploy Solr
 def solr_cluster():
-    execute(collect_ip_addresses,hosts=env.roledefs['production'])
-    execute(unpack_solr,hosts=env.roledefs['production'])
-    execute(setup_solr_service, hosts=env.roledefs['production'])
-    execute(setup_solr_master, hosts=env.roledefs['master'])
-    execute(setup_solr_slave, hosts=env.roledefs['slaves'])
+    rollout(solr_steps)
 
 
 # Deploy Zookeeper
 def zookeeper_cluster():
-    execute(unpack_zookeeper, hosts=env.roledefs['production'])
-    execute(setup_zookeeper_service, hosts=env.roledefs['production'])
+    rollout(zookeeper_steps)
 
 
-# Deploy base packages to all machines
+# Deploy base packages to a single machine
 @roles('production')
-def setup_environment():
+def setup_host():
     with hide('running','output','warnings'):
-        setup_repo(repos['pgdg'])
-        setup_repo(repos['dotdeb'])
-        apt_update()
-        map(install,packages['postgres'])
-        map(install,packages['redis'])
-        map(install,packages['base'])
-        map(install,packages['python'])
-        pip_install(packages['pip'])
+        if not apt_bundle['enabled']:
+            setup_repo('pgdg')
+            setup_repo('dotdeb')
+            apt_update()
+        install_packages(['postgres', 'redis', 'base', 'python', 'java'])
         inject_files(configuration_files)
-    shared_redis()
-    postgres_cluster()
 
 
-# Deploy our project
-@roles('production')
-def deploy_project():
-    rsync_project(remote_dir='/srv/project', delete=True, exclude='.git')
+# Deploy base packages and the Python virtualenv to all machines, then bring up redis, postgres and pgbouncer
+def setup_environment():
+    rollout(apt_steps + [(setup_host, 'production')] + python_steps + redis_steps + postgres_steps + pgbouncer_steps)
+
 
+# Install the base packages on the development box from the APT bundle kept on the
+# controller, without touching the network (needs config.apt_bundle enabled, and
+# build_apt_bundle to have run once)
+def setup_development():
+    rollout([(install_apt_bundle, 'development'), (setup_host, 'development')])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+APT bundle
+
+Resolves the full dependency closure of every apt package group in config.packages
+once, on the master (which has the pgdg and dotdeb repositories set up), downloads
+the .deb files into a flat repository and ships it through the artifact cache, so
+the slaves pull it from the master over the LAN. Every box then installs from it as
+a local `file:` repository, with apt confined to it, and nothing else talks to the
+mirrors.
+
+The bundle is kept on the controller too, so the development box can be pointed at
+it without network access.
+"""
+
+import os, json, tempfile
+from hashlib import sha1
+from fabric.api import env, hide, settings, abort, execute
+from fabric.operations import sudo, get
+from .batch import Batch
+from .debian import setup_repo, bundle_list, apt_sources
+from .facts import invalidate_facts
+from .artifacts import add_artifact, local_path, remote_path, has_artifact, push_artifact, spread_artifacts
+from .config import state_dir, load_json, save_json, repos, packages, apt_bundle
+
+index_file   = os.path.join(state_dir, 'apt-bundle.json')
+closure_file = apt_bundle['remote_dir'] + '/.closure'
+
+
+def apt_packages():
+    return sorted(set(p for group, names in packages.items() if group != 'pip' for p in names))
+
+
+def closure_hash():
+    """Identifies the package list and the repositories it was resolved against"""
+    return sha1(json.dumps([apt_packages(), repos], sort_keys=True)).hexdigest()[:16]
+
+
+def load_index():
+    return load_json(index_file, {})
+
+
+def save_index(index):
+    save_json(index_file, index)
+
+
+def download_closure(closure):
+    """Download every package (and everything it depends on) on the current host and bring the repository back"""
+    for name in sorted(repos):
+        setup_repo(name)
+    build = '/tmp/apt-bundle-%s' % closure
+    with Batch() as b:
+        b.sudo('apt-get -y update && DEBIAN_FRONTEND=noninteractive apt-get -y install dpkg-dev')
+        b.sudo('rm -rf %s && mkdir -p %s' % (build, build))
+        # virtual packages show up in the closure too, and have nothing to download
+        b.sudo("cd %s && apt-cache depends --recurse --no-recommends --no-suggests --no-conflicts --no-breaks "
+               "--no-replaces --no-enhances %s | grep '^[a-z0-9]' | sort -u | "
+               "while read p; do apt-get download $p >/dev/null 2>&1 || true; done" % (build, ' '.join(apt_packages())))
+        b.sudo('cd %s && dpkg-scanpackages . /dev/null 2>/dev/null | gzip -9 > Packages.gz' % build)
+        b.sudo('tar -czf %s.tgz -C %s .' % (build, build))
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    with hide('running'):
+        get('%s.tgz' % build, path, use_sudo=True)
+        sudo('rm -rf %s %s.tgz' % (build, build))
+    return add_artifact(path)
+
+
+def build_apt_bundle(rebuild=False):
+    """Resolve and download the .deb closure on the master (once per package list) and spread it to every box"""
+    closure = closure_hash()
+    index = load_index()
+    checksum = index.get(closure)
+    if not checksum or not os.path.exists(local_path(checksum)) or rebuild in [True, 'True', 'true', '1', 'yes']:
+        master = env.roledefs['master'][0]
+        print "Building APT bundle %s on %s" % (closure, master)
+        checksum = execute(download_closure, closure, hosts=[master])[master]
+        index[closure] = checksum
+        save_index(index)
+    spread_artifacts([checksum])
+    print "APT bundle %s (%s) is on every box" % (closure, checksum[:12])
+    return checksum
+
+
+def install_apt_bundle():
+    """Unpack the bundle as a local repository on the current host and refresh apt's lists from it alone"""
+    closure = closure_hash()
+    checksum = load_index().get(closure)
+    if not checksum:
+        abort("no APT bundle built for %s, run build_apt_bundle first" % closure)
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        if sudo('cat %s' % closure_file).strip() == closure:
+            return False
+    # the development box (or one that missed the fan-out) gets it straight from the controller
+    if not has_artifact(checksum):
+        push_artifact(checksum)
+    repo = apt_bundle['remote_dir']
+    with Batch() as b:
+        b.sudo('rm -rf %s.tmp && mkdir -p %s.tmp && tar -xzf %s -C %s.tmp' % (repo, repo, remote_path(checksum), repo))
+        b.sudo('echo %s > %s.tmp/.closure && rm -rf %s && mv -T %s.tmp %s' % (closure, repo, repo, repo, repo))
+        b.put('deb [trusted=yes] file:%s ./\n' % repo, bundle_list, perms='0644', owner='root:root')
+        b.sudo('apt-get -q %s update' % apt_sources())
+    invalidate_facts()
+    print "[%s] installing from APT bundle %s" % (env.host, closure)
+    return True
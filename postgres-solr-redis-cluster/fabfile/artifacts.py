@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Artifact cache
+
+Tarballs are downloaded once to a content-addressed cache on the controller and
+checked against a known SHA-256 (either pinned in config.tarballs or recorded the
+first time we fetch them). Each one is pushed to the master, which then serves it
+to the slaves over a short-lived HTTP server so they pull it in parallel across
+the LAN. The server runs unprivileged, listens only on the cluster interface and
+sees nothing but the artifacts being handed out. Hosts that already hold a matching copy are skipped.
+"""
+
+import os, shutil, tempfile, urllib2
+from hashlib import sha256
+from fabric.api import env, hide, settings, abort, execute
+from fabric.operations import run, sudo, put
+from .config import state_dir, load_json, save_json, tarballs, artifacts as artifact_settings
+from .batch import quote
+from .rollout import fan_out, Failure
+from .facts import get_facts
+
+cache_dir  = os.path.join(state_dir, 'artifacts')
+index_file = os.path.join(cache_dir, 'index.json')
+remote_dir = artifact_settings['remote_dir']
+
+# SimpleHTTPServer on its own binds to every interface
+server_script = ('import sys, BaseHTTPServer, SimpleHTTPServer; BaseHTTPServer.HTTPServer('
+                 '(sys.argv[1], int(sys.argv[2])), SimpleHTTPServer.SimpleHTTPRequestHandler).serve_forever()')
+
+
+def load_index():
+    return load_json(index_file, {})
+
+
+def save_index(index):
+    save_json(index_file, index)
+
+
+def expected_checksum(url):
+    """The pinned checksum for a URL, or the one we recorded on first download"""
+    for spec in tarballs.values():
+        if spec['url'] == url and spec.get('sha256'):
+            return spec['sha256']
+    return load_index().get(url)
+
+
+def fetch(url):
+    """Download a URL into the local cache (once), returning its SHA-256"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    expected = expected_checksum(url)
+    if expected and os.path.exists(local_path(expected)):
+        return expected
+
+    print "Fetching %s" % url
+    proxy = artifact_settings.get('proxy')
+    opener = urllib2.build_opener(urllib2.ProxyHandler({'http': proxy, 'https': proxy} if proxy else {}))
+    digest = sha256()
+    handle, tmp = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(handle, 'wb') as out:
+        response = opener.open(url)
+        for chunk in iter(lambda: response.read(1024 * 1024), ''):
+            digest.update(chunk)
+            out.write(chunk)
+    checksum = digest.hexdigest()
+    if expected and checksum != expected:
+        os.remove(tmp)
+        abort("checksum mismatch for %s: expected %s, got %s" % (url, expected, checksum))
+    shutil.move(tmp, local_path(checksum))
+    index = load_index()
+    index[url] = checksum
+    save_index(index)
+    return checksum
+
+
+def local_path(checksum):
+    return os.path.join(cache_dir, checksum)
+
+
+def remote_path(checksum):
+    return '%s/%s' % (remote_dir, checksum)
+
+
+def verify_command(checksum):
+    return 'echo "%s  %s" | sha256sum -c --status' % (checksum, remote_path(checksum))
+
+
+def has_artifact(checksum):
+    """True if the current host already holds a good copy"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        return run(verify_command(checksum)).succeeded
+
+
+def push_artifact(checksum):
+    """Upload an artifact from the controller cache to the current host, unless it is already there"""
+    if has_artifact(checksum):
+        return False
+    sudo('mkdir -p %s' % remote_dir)
+    put(local_path(checksum), remote_path(checksum) + '.tmp', use_sudo=True)
+    sudo('mv -f %s.tmp %s && %s' % (remote_path(checksum), remote_path(checksum), verify_command(checksum)))
+    return True
+
+
+def pull_artifacts(checksums, source):
+    """Fetch artifacts the current host is missing from a peer's HTTP server"""
+    fetched = []
+    for checksum in checksums:
+        if has_artifact(checksum):
+            continue
+        # the peer's server may still be coming up, so retry refused connections for a bit
+        sudo('mkdir -p %s && wget -q --tries=10 --retry-connrefused --waitretry=1 -O %s.tmp http://%s/%s'
+             ' && mv -f %s.tmp %s && %s' % (
+            remote_dir, remote_path(checksum), source, checksum,
+            remote_path(checksum), remote_path(checksum), verify_command(checksum)))
+        fetched.append(checksum)
+    return fetched
+
+
+def start_server(checksums, address):
+    """Serve only the given artifacts from the current host, on one address and as an unprivileged
+    user, returning the server's PID and the directory it serves"""
+    with hide('running', 'output'):
+        serve_dir = sudo('d=$(mktemp -d /tmp/artifacts.XXXXXX) && chmod 755 $d && %s && echo $d' % ' && '.join(
+            'ln -s %s $d/%s' % (remote_path(c), c) for c in checksums)).strip()
+        pid = sudo('cd %s && (nohup python -c %s %s %d > /dev/null 2>&1 & echo $!)' % (
+            serve_dir, quote(server_script), address, artifact_settings['port']),
+            user=artifact_settings['serve_as'], pty=False).strip()
+    return pid, serve_dir
+
+
+def stop_server(pid, serve_dir):
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        sudo('kill %s; rm -rf %s' % (pid, serve_dir))
+
+
+def missing_artifacts(checksums):
+    return [c for c in checksums if not has_artifact(c)]
+
+
+def add_artifact(path):
+    """Move a file built on the controller into the artifact cache, returning its SHA-256"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    checksum = digest.hexdigest()
+    shutil.move(path, local_path(checksum))
+    return checksum
+
+
+def spread_artifacts(checksums, intf='eth0'):
+    """Push cached artifacts to the master and have the slaves pull them from it in parallel.
+
+    Returns which artifacts each slave had to pull."""
+    master = env.roledefs['master'][0]
+    slaves = env.roledefs['slaves']
+
+    for checksum in checksums:
+        execute(push_artifact, checksum, hosts=[master])
+
+    missing = fan_out(missing_artifacts, slaves, checksums)
+    failed = dict((h, r) for h, r in missing.items() if isinstance(r, Failure))
+    missing = dict((h, r) for h, r in missing.items() if r and h not in failed)
+    if missing:
+        master_ip = execute(get_facts, hosts=[master])[master]['interfaces'][intf]
+        pid, serve_dir = execute(start_server, checksums, master_ip, hosts=[master])[master]
+        try:
+            pulled = fan_out(pull_artifacts, missing.keys(), checksums, '%s:%d' % (master_ip, artifact_settings['port']))
+        finally:
+            execute(stop_server, pid, serve_dir, hosts=[master])
+        failed.update((h, r) for h, r in pulled.items() if isinstance(r, Failure))
+    if failed:
+        abort("artifact distribution failed on %s" % ', '.join("%s (%s)" % (h, failed[h].reason) for h in sorted(failed)))
+    return missing
+
+
+def distribute_artifacts(names=None, intf='eth0'):
+    """Fetch tarballs once on the controller, push them to the master and fan them out to the slaves"""
+    if isinstance(names, basestring):
+        names = [names]
+    names = names or sorted(tarballs.keys())
+    checksums = [fetch(tarballs[name]['url']) for name in names]
+    missing = spread_artifacts(checksums, intf)
+    for name, checksum in zip(names, checksums):
+        print "%s (%s): %d of %d slaves pulled it from %s" % (
+            name, checksum[:12], sum(checksum in m for m in missing.values()), len(env.roledefs['slaves']),
+            env.roledefs['master'][0])
+    return dict(zip(names, checksums))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Remote command batching
+
+Queues up sudo commands, file uploads and line appends and ships them to the host
+as a single generated script, so a chain of small steps costs one SSH round-trip
+instead of one per step. Each step's exit status and output is still captured
+separately, so failures are reported against the exact command that broke.
+"""
+
+import uuid
+from base64 import b64encode
+from StringIO import StringIO
+from fabric.api import env, hide, settings, abort, warn
+from fabric.operations import sudo, put
+from fabric.state import output
+from .trace import label
+
+# bash -c gets the whole (base64-encoded) script as a single argument, which Linux
+# caps at 128KB - this is checked against the encoded length, leaving room for the
+# command around it and Fabric's sudo/shell wrapping
+inline_limit = 96 * 1024
+
+
+class StepResult(str):
+    """Output of a batched step, with the same success attributes as Fabric's own results"""
+
+    def __new__(cls, value, command, return_code):
+        result = str.__new__(cls, value)
+        result.command = command
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+def quote(value):
+    """Single-quote a value for the shell"""
+    return "'%s'" % value.replace("'", "'\\''")
+
+
+class Batch(object):
+    """A queue of remote operations that runs as one script under sudo"""
+
+    def __init__(self):
+        self.steps = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.execute()
+
+    def sudo(self, command, warn_only=False, unless=None):
+        """Queue a command, optionally skipping it when the `unless` test succeeds"""
+        if unless:
+            command = '%s || { %s; }' % (unless, command)
+        self.steps.append((command, warn_only))
+        return self
+
+    def put(self, content, path, perms=None, owner=None, only_if_missing=False):
+        """Queue an upload of a string, written via a temporary file and renamed into place"""
+        commands = ['echo %s | base64 -d > %s.tmp' % (b64encode(content), quote(path))]
+        if perms:
+            commands.append('chmod %s %s.tmp' % (perms, quote(path)))
+        if owner:
+            commands.append('chown %s %s.tmp' % (owner, quote(path)))
+        commands.append('mv -f %s.tmp %s' % (quote(path), quote(path)))
+        return self.sudo(' && '.join(commands), unless=('[ -e %s ]' % quote(path)) if only_if_missing else None)
+
+    def append(self, path, line):
+        """Queue appending a line to a file, unless it is already there"""
+        return self.sudo('echo %s >> %s' % (quote(line), quote(path)),
+                         unless='grep -qxF -- %s %s 2>/dev/null' % (quote(line), quote(path)))
+
+    def script(self, marker):
+        lines = ['#!/bin/bash']
+        for i, (command, warn_only) in enumerate(self.steps):
+            lines.append("echo '%s %d'" % (marker, i))
+            # steps never read the session's stdin, so nothing can swallow input meant for later steps
+            lines.append('( %s ) < /dev/null 2>&1' % command)
+            lines.append("rc=$?; printf '\\n%s %d %%d\\n' $rc" % (marker, i))
+            if not warn_only:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, out, marker):
+        """Split the combined output back into one result per step that ran"""
+        results, current, buf = [], None, []
+        for line in out.replace('\r\n', '\n').split('\n'):
+            if line.startswith(marker + ' '):
+                fields = line.split()
+                if len(fields) == 2:
+                    current, buf = int(fields[1]), []
+                elif current is not None:
+                    # drop the newline we forced in before the status line
+                    text = '\n'.join(buf)
+                    text = text[:-1] if text.endswith('\n') else text
+                    results.append(StepResult(text, self.steps[current][0], int(fields[2])))
+                    current = None
+            elif current is not None:
+                buf.append(line)
+        return results
+
+    def execute(self):
+        """Run every queued step in a single remote invocation"""
+        if not self.steps:
+            return []
+        marker = '@@batch-%s' % uuid.uuid4().hex[:12]
+        script = self.script(marker)
+        with settings(hide('running', 'output', 'warnings'), warn_only=True), label('batch of %d steps' % len(self.steps)):
+            encoded = b64encode(script)
+            if len(encoded) < inline_limit:
+                out = sudo('/bin/bash -c "$(echo %s | base64 -d)"' % encoded)
+            else:
+                path = '/tmp/fabric-%s.sh' % marker[8:]
+                put(StringIO(script), path, use_sudo=True)
+                out = sudo('/bin/bash %s; rc=$?; rm -f %s; exit $rc' % (path, path))
+        self.results = self.parse(out, marker)
+        for result in self.results:
+            if output.running:
+                print "[%s] batch: %s" % (env.host_string, result.command)
+            if output.stdout and result:
+                print '\n'.join("[%s] out: %s" % (env.host_string, l) for l in result.split('\n'))
+        failed = [r for r, (c, w) in zip(self.results, self.steps) if r.failed and not w]
+        if failed:
+            message = "[%s] batched command failed with exit code %d: %s\n%s" % (
+                env.host_string, failed[0].return_code, failed[0].command, failed[0])
+            (warn if env.warn_only else abort)(message)
+        elif len(self.results) < len(self.steps):
+            (warn if env.warn_only else abort)("[%s] batch stopped after %d of %d steps:\n%s" % (
+                env.host_string, len(self.results), len(self.steps), out))
+        self.steps = []
+        return self.results
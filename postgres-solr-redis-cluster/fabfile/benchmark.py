@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+
+Runs pgbench, redis-benchmark and a Solr query mix on every box at once, and keeps
+the numbers on the controller together with a hash of the configuration that was
+deployed at the time. Each run is compared with a baseline run so a change that
+makes things slower shows up straight away.
+
+Works against either the production boxes or the `development` role (where the
+one box plays both master and standby).
+"""
+
+import os, json
+from base64 import b64encode
+from hashlib import sha1
+from datetime import datetime
+from fabric.api import env, hide, settings, abort, execute
+from fabric.operations import sudo
+from .debian import install_packages
+from .sql import Session
+from .batch import quote
+from .managed import pushed_dir
+from .helpers import collect_ip_addresses
+from .rollout import fan_out, run_step, Failure
+from .config import state_dir, load_json, save_json, postgres, redis, solr, benchmark as options
+
+results_dir   = os.path.join(state_dir, 'benchmarks')
+baseline_file = os.path.join(results_dir, 'baseline.json')
+
+# metrics where a smaller number is the better one
+lower_is_better = ('_ms', '_errors')
+
+
+def plays_master(role):
+    return role == 'development' or env.host in env.roledefs['master']
+
+
+def config_hash(hosts):
+    """Hash of the config module and of every file last pushed to the hosts under test"""
+    digest = sha1(json.dumps([postgres, redis, solr, options], sort_keys=True, default=str))
+    for host in sorted(hosts):
+        path = os.path.join(pushed_dir, host)
+        for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+            with open(os.path.join(path, name)) as f:
+                digest.update(name + f.read())
+    return digest.hexdigest()[:12]
+
+
+def pgbench_path():
+    return '/usr/lib/postgresql/%s/bin/pgbench' % postgres['version']
+
+
+def prepare_pgbench():
+    """Create and populate the pgbench database on the master, once"""
+    install_packages(['benchmark'])
+    with hide('running'):
+        with Session() as s:
+            s.run("SELECT 1 FROM pg_database WHERE datname = 'pgbench';")
+    if not s.results[0].rows:
+        sudo('createdb pgbench && %s -i -q -s %d pgbench' % (pgbench_path(), options['pgbench']['scale']), user='postgres')
+
+
+def run_pgbench(role):
+    """TPC-B on the master, select-only on standbys (which can't take writes)"""
+    p = options['pgbench']
+    mode = '' if plays_master(role) else '-S -n'
+    with settings(hide('running', 'output')):
+        out = sudo('%s %s -c %d -j %d -T %d -p %d pgbench' % (
+            pgbench_path(), mode, p['clients'], p['threads'], p['seconds'], p['port']), user='postgres')
+    for line in out.splitlines():
+        # tps = 1234.567890 (excluding connections establishing)
+        if line.startswith('tps =') and 'excluding' in line:
+            return {'pgbench_%s_tps' % ('rw' if plays_master(role) else 'ro'): float(line.split()[2])}
+    return {}
+
+
+def run_redis_benchmark(role):
+    """redis-benchmark against the primary everyone shares (localhost in development or sharded mode)"""
+    r = options['redis']
+    target = '127.0.0.1'
+    if role != 'development' and redis['mode'] != 'cluster':
+        target = env.addresses[env.roledefs['master'][0]]['eth0']
+    with settings(hide('running', 'output')):
+        out = sudo('redis-benchmark -h %s -p %d -a %s -n %d -c %d -P %d -t %s --csv' % (
+            target, redis['port'], quote(redis['password']), r['requests'], r['clients'], r['pipeline'], r['tests']))
+    metrics = {}
+    for line in out.splitlines():
+        fields = [f.strip('"') for f in line.strip().split(',')]
+        if len(fields) == 2:
+            try:
+                metrics['redis_%s_rps' % fields[0].split()[0].lower()] = float(fields[1])
+            except ValueError:
+                pass
+    return metrics
+
+
+def run_solr_queries(role):
+    """Fire the configured query mix at the local Solr node and time it"""
+    q = options['solr']
+    settings_blob = b64encode(json.dumps({
+        'url': 'http://localhost:%d/solr/%s/select' % (solr['port'], solr['collection']),
+        'mix': q['mix'], 'requests': q['requests'], 'concurrency': q['concurrency']}))
+    with settings(hide('running', 'output')):
+        out = sudo('echo %s | base64 -d | python - %s' % (b64encode(solr_script), settings_blob))
+    stats = json.loads(out.strip().splitlines()[-1])
+    return dict(('solr_%s' % k, v) for k, v in stats.items())
+
+
+def run_benchmarks(role):
+    """Every benchmark on the current host, one after the other so they don't skew each other"""
+    install_packages(['benchmark'])
+    metrics = {}
+    for name, bench in [('pgbench', run_pgbench), ('redis', run_redis_benchmark), ('solr', run_solr_queries)]:
+        if name in options['suites']:
+            metrics.update(bench(role))
+    return metrics
+
+
+def compare(run, baseline, tolerance):
+    """Print each metric against the baseline, returning the ones that got worse by more than the tolerance"""
+    regressions = []
+    print "\nBenchmark %s (config %s) against baseline %s (config %s)" % (
+        run['timestamp'], run['config_hash'], baseline['timestamp'], baseline['config_hash'])
+    for host in sorted(run['results']):
+        for metric in sorted(run['results'][host]):
+            now, then = run['results'][host][metric], baseline['results'].get(host, {}).get(metric)
+            if then is None:
+                print "  %-14s %-26s %12.1f" % (host, metric, now)
+                continue
+            if then == 0:
+                # no ratio to take, so anything appearing where there was none counts in full
+                change = 1.0 if now > 0 else 0.0
+                worse = change if metric.endswith(lower_is_better) else 0.0
+            else:
+                change = (now - then) / float(then)
+                worse = -change if not metric.endswith(lower_is_better) else change
+            flag = '!!' if worse > tolerance else '  '
+            if worse > tolerance:
+                regressions.append((host, metric, then, now))
+            print "%s %-14s %-26s %12.1f %12.1f %+7.1f%%" % (flag, host, metric, then, now, change * 100)
+    return regressions
+
+
+def benchmark(role='production', baseline=False):
+    """Benchmark every box in a role in parallel, store the results and compare them with the baseline"""
+    hosts = env.roledefs[role]
+    if role != 'development':
+        run_step(collect_ip_addresses, role)
+    if 'pgbench' in options['suites']:
+        execute(prepare_pgbench, hosts=hosts[:1] if role == 'development' else env.roledefs['master'])
+    results = fan_out(run_benchmarks, hosts, role)
+    failed = dict((h, r) for h, r in results.items() if isinstance(r, Failure))
+    if failed:
+        abort("benchmarks failed on %s" % ', '.join("%s (%s)" % (h, failed[h].reason) for h in sorted(failed)))
+
+    run = {
+        'timestamp'  : datetime.now().strftime('%Y%m%dT%H%M%S'),
+        'role'       : role,
+        'config_hash': config_hash(hosts),
+        'results'    : results,
+    }
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    path = os.path.join(results_dir, '%s-%s.json' % (run['timestamp'], run['config_hash']))
+    save_json(path, run)
+    print "Saved %s" % path
+    if baseline in [True, 'True', 'true', '1', 'yes'] or not os.path.exists(baseline_file):
+        save_json(baseline_file, run)
+        print "Saved as the baseline"
+        return []
+    regressions = compare(run, load_json(baseline_file), options['tolerance'])
+    if regressions:
+        print "\n%d metrics regressed by more than %d%%" % (len(regressions), options['tolerance'] * 100)
+    return regressions
+
+
+def set_baseline(name=None):
+    """Make a stored run (the latest by default) the baseline for comparisons"""
+    runs = sorted(f for f in os.listdir(results_dir) if f != os.path.basename(baseline_file)) if os.path.isdir(results_dir) else []
+    matches = [f for f in runs if not name or f.startswith(name)]
+    if not matches:
+        abort("no stored benchmark run matches %r" % name)
+    save_json(baseline_file, load_json(os.path.join(results_dir, matches[-1])))
+    print "Baseline is now %s" % matches[-1]
+
+
+solr_script = r'''
+import sys, json, time, random, base64, urllib, urllib2, threading
+options = json.loads(base64.b64decode(sys.argv[1]))
+random.seed(42)
+mix = []
+for query in options['mix']:
+    params = dict((k, v) for k, v in query.items() if k != 'weight')
+    params['wt'] = 'json'
+    mix += [params] * int(query.get('weight', 1))
+plan = [random.choice(mix) for i in range(options['requests'])]
+latencies, errors, lock = [], [0], threading.Lock()
+
+def worker():
+    while True:
+        with lock:
+            if not plan:
+                return
+            params = plan.pop()
+        started = time.time()
+        try:
+            urllib2.urlopen(options['url'] + '?' + urllib.urlencode(params), timeout=30).read()
+            with lock:
+                latencies.append((time.time() - started) * 1000)
+        except Exception:
+            with lock:
+                errors[0] += 1
+
+started = time.time()
+threads = [threading.Thread(target=worker) for i in range(options['concurrency'])]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.time() - started
+latencies.sort()
+pick = lambda p: round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 1) if latencies else 0
+print json.dumps({'qps': round(len(latencies) / elapsed, 1), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95),
+                  'p99_ms': pick(0.99), 'query_errors': errors[0]})
+'''
@@ -8,6 +8,29 @@ This file contains shared constants/dictionaries for the fabfile
 Created by: Rui Carmo
 """
 
+import os, json
+
+# Controller-side state (fact cache and friends) lives alongside the fabfile
+state_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.state')
+
+
+def load_json(path, default=None):
+    """Read a state file, or return `default` if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Write a state file and rename it into place, so parallel readers never see a partial file"""
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
 # copy our configuration files to a specific location and set permissions
 # (this is a sample for an old Postgres deployment)
 skel = {
@@ -45,13 +68,25 @@ repos = {
 }
 
 
+# Install apt packages from a bundle of every .deb in config.packages (and their
+# dependencies), downloaded once on the master and unpacked on each box as a local
+# repository - only the master needs to reach the repositories above
+apt_bundle = {
+    'enabled'   : False,
+    'remote_dir': '/var/cache/fabric/apt'
+}
+
+
 # Package groups I usually deploy on servers
 packages = {
     "base"    : ['vim', 'htop', 'tmux', 'wget', 'netcat', 'rsync', 'bmon', 'speedometer', 'jpegoptim', 'imagemagick'],
     "postgres": ['postgresql-9.2', 'postgresql-client-9.2', 'libpq-dev'],
     "redis"   : ['redis-server'],
-    "python"  : ['python2.7-dev', 'libevent-dev', 'python-setuptools'],
+    "python"  : ['python2.7-dev', 'libevent-dev', 'python-setuptools', 'python-virtualenv'],
     "java"    : ['openjdk-7-jre-headless'],
+    "pgbouncer": ['pgbouncer'],
+    "benchmark": ['postgresql-contrib-9.2'],
+    # pinned, built into wheels once and installed offline (see `wheelhouse` below)
     "pip"     : [
         "gunicorn==0.17.4",
         "gevent==0.13.8",
@@ -64,6 +99,19 @@ packages = {
 }
 
 
+# Where the pip packages are built and installed - the pip and wheel pins are only
+# used to build and to bootstrap each virtualenv, they don't count as app packages
+wheelhouse = {
+    'virtualenv': '/srv/venv',
+    # None builds on the master
+    'build_host': None,
+    'pip'       : 'pip==1.5.6',
+    'wheel'     : 'wheel==0.24.0'
+}
+
+
+# Tarballs are fetched once by the controller - add a 'sha256' key to pin a checksum,
+# otherwise the one seen on first download is recorded and enforced from then on
 tarballs = {
     "solr": {
         'url'   : 'http://mirrors.fe.up.pt/pub/apache/lucene/solr/4.4.0/solr-4.4.0.tgz',
@@ -75,6 +123,185 @@ tarballs = {
     }
 }
 
+# Where artifacts are kept on the hosts, and how the master serves them to its peers
+artifacts = {
+    'remote_dir': '/var/cache/fabric/artifacts',
+    'port'      : 8765,
+    # the master's server runs as this user and only sees the artifacts it is handing out
+    'serve_as'  : 'nobody',
+    # set this if the controller needs a proxy to reach the outside world
+    'proxy'     : None
+}
+
+# How many hosts the rollout engine works on at once (`fab -z N` overrides this)
+concurrency = {
+    'pool_size': 3
+}
+
+# Postgres cluster settings
+postgres = {
+    # application database and role
+    'database'       : 'project',
+    'user'           : 'project',
+    'password'       : 'project',
+    # must match the locale the cluster was initdb'ed with
+    'version'        : '9.2',
+    'locale'         : 'en_US.UTF-8',
+    # only used when pgbouncer is disabled
+    'max_connections': 1000,
+    # tuning profile: 'oltp', 'mixed' or 'reporting'
+    'workload'       : 'mixed',
+    # ask for SSL compression on the link when seeding standbys
+    'seed_compress'  : False
+}
+
+# Connection pooling in front of Postgres - apps connect to port 6432, using the
+# 'project' database for writes (routed to the master) and 'project_ro' for reads
+# (routed to the standby on the same box). When enabled, Postgres' max_connections
+# is sized to the pools instead of config.postgres['max_connections']
+pgbouncer = {
+    'enabled'        : True,
+    'port'           : 6432,
+    'pool_mode'      : 'transaction',
+    'max_client_conn': 2000,
+    'pool_per_core'  : 2,
+    # extra backends for superusers, replication and maintenance
+    'headroom'       : 20
+}
+
+# Redis settings shared by every box
+redis = {
+    'port'        : 6379,
+    'password'    : 'project',
+    'version'     : '2.8',
+    # tuning profile: 'broker' (celery, never evicts), 'cache' (LRU, no persistence)
+    # or 'store' (RDB + AOF)
+    'role'        : 'broker',
+    # share of the box's RAM redis may use before the eviction policy kicks in
+    'memory_share': 0.25,
+    # the master box holds the primary, slaves replicate from it, and a Sentinel on
+    # every box promotes a replica if the primary goes away
+    'sentinel'    : {
+        'port'               : 26379,
+        'name'               : 'project',
+        'quorum'             : 2,
+        'down_after_ms'      : 5000,
+        'failover_timeout_ms': 60000
+    },
+    # 'replicated' (one primary, Sentinel failover) or 'cluster' (hash slots sharded
+    # across every production box - needs redis 5.0 or later)
+    'mode'        : 'replicated',
+    'cluster'     : {
+        # replicas per primary - with more than 0 you need more boxes than primaries
+        'replicas'       : 0,
+        'node_timeout_ms': 5000
+    },
+    # first port used by `fab local_redis` for a throwaway topology on localhost
+    'local_port'  : 7000
+}
+
+# SolrCloud layout and JVM sizing - the heap gets a share of the RAM Postgres, Redis and
+# ZooKeeper don't claim (less an OS reserve), and the rest is left to the page cache
+solr = {
+    'port'          : 8983,
+    'collection'    : 'project',
+    # the planner splits shards that would grow past either of these
+    'shard_max_mb'  : 10240,
+    'shard_max_docs': 20000000,
+    'heap_share'    : 0.5,
+    'max_heap_mb'   : 31744,
+    'os_reserve_mb' : 1024,
+    # rotated as gc.log.0 to gc.log.4, in a directory of its own that Solr's user can write to
+    'gc_log'        : '/var/log/solr/gc.log'
+}
+# NOTE: upload_solr_collection runs rsync on the boxes as `sudo -u www-data rsync`, so the
+# deploy user needs passwordless sudo for that (e.g. `deploy ALL=(www-data) NOPASSWD: /usr/bin/rsync`)
+
+# Rebuilding the Solr index from Postgres (`fab reindex_solr`): every column the query
+# returns becomes a field of the same name. Partitioning splits the (integer) key into
+# equal ranges that the workers take in turn
+reindex = {
+    'query'     : 'SELECT * FROM documents',
+    'table'     : 'documents',
+    'key'       : 'id',
+    'batch_size': 5000,
+    'workers'   : 4,
+    'partitions': 16
+}
+
+# ZooKeeper ensemble - point data_log_dir at its own disk if the box has one, so
+# transaction log fsyncs don't queue behind snapshot writes
+zookeeper = {
+    'client_port'      : 2181,
+    'data_log_dir'     : '/srv/data/zookeeper-txlog',
+    'snap_retain_count': 5,
+    'purge_interval_h' : 24,
+    'max_client_cnxns' : 200,
+    # None sizes the heap from the box's RAM
+    'heap_mb'          : None,
+    # mntr averages above this (in ms) are flagged by zookeeper_health
+    'max_avg_latency'  : 50
+}
+
+# Project releases (`fab deploy_project`, `fab rollback_project`) - gunicorn should run
+# from remote_dir/current and write its pid to `pidfile` so it can be reloaded
+# NOTE: the slaves pull the packed tree from the master's artifact server, which anything on
+# the cluster network can read (unauthenticated, on artifacts['port']) while a deploy runs
+project = {
+    'local_dir'    : '.',
+    'remote_dir'   : '/srv/project',
+    'exclude'      : ['.git', '.state', '*.pyc'],
+    # the live and previous releases count towards this
+    'keep_releases': 5,
+    'pidfile'      : '/var/run/gunicorn.pid',
+    'reload_signal': 'HUP'
+}
+
+# Benchmark suite (`fab benchmark` or `fab benchmark:role=development`) - runs are kept
+# under .state/benchmarks and metrics more than `tolerance` worse than the baseline are flagged
+benchmark = {
+    'suites'   : ['pgbench', 'redis', 'solr'],
+    'tolerance': 0.10,
+    'pgbench'  : {'scale': 10, 'clients': 8, 'threads': 2, 'seconds': 30, 'port': 5432},
+    'redis'    : {'requests': 100000, 'clients': 50, 'pipeline': 16, 'tests': 'set,get,incr,lpush,lpop'},
+    'solr'     : {
+        'requests'   : 2000,
+        'concurrency': 8,
+        # relative weights of each query shape; everything but 'weight' is passed to /select
+        'mix'        : [
+            {'weight': 6, 'q': '*:*', 'rows': 10},
+            {'weight': 3, 'q': 'text:project', 'rows': 20},
+            {'weight': 1, 'q': '*:*', 'rows': 0, 'facet': 'true', 'facet.field': 'id'}
+        ]
+    }
+}
+
+# Every fab task is timed per command, task and host - the Chrome traces land in
+# .state/traces and the `top` slowest steps are printed when the task finishes
+trace = {
+    'enabled': True,
+    'top'    : 10,
+    'keep'   : 50
+}
+
+# Services that handlers may act on, and whether their init script can reload
+# configuration in place (SIGHUP) instead of restarting
+services = {
+    'postgresql'    : {'reload': True},
+    'pgbouncer'     : {'reload': True},
+    'redis-server'  : {'reload': False},
+    'redis-sentinel': {'reload': False},
+    'solr'          : {'reload': False},
+    'zookeeper'     : {'reload': False},
+}
+
+# Host facts are cached locally for this many seconds before being gathered again
+facts = {
+    'ttl'     : 3600,
+    # init scripts whose state is recorded with the facts
+    'services': ['postgresql', 'pgbouncer', 'redis-server', 'redis-sentinel', 'solr', 'zookeeper']
+}
+
 configuration_files = {
     "/etc/profile.d/ourenv.sh": 'export OURSETTING1=OURVALUE1\nexport OURSETTING2=OURVALUE2'
 }
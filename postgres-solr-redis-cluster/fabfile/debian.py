@@ -6,7 +6,27 @@ Debian/Ubuntu specific tasks
 Created by: Rui Carmo
 """
 
-def setup_repo(repo):
+import time
+from StringIO import StringIO
+from fabric.api import env
+from fabric.operations import run, sudo, put, hide, settings
+from fabric.contrib.files import contains, exists
+from .config import repos, packages as package_groups, apt_bundle
+from .facts import invalidate_facts
+
+# sources list for the local APT bundle (see aptbundle.py)
+bundle_list = '/etc/apt/sources.list.d/fabric-bundle.list'
+
+
+def apt_sources():
+    """apt-get options that confine it to the local bundle, when one is in use"""
+    if not apt_bundle['enabled']:
+        return ''
+    return '-o Dir::Etc::sourcelist=%s -o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0' % bundle_list
+
+
+def setup_repo(name):
+    repo = repos[name]
     if not contains('/etc/apt/trusted.gpg', repo["key_name"], use_sudo=True):
         print("Retrieving repository key %s" % repo["key_url"])
         sudo('/usr/bin/wget --quiet -O - %s | sudo apt-key add -' % repo["key_url"])
@@ -28,15 +48,41 @@ def installed(package):
 def install(package):
     if not installed(package):
         with settings(warn_only=True):
-            return sudo('apt-get -y install %s' % package).succeeded
+            return sudo('apt-get -y %s install %s' % (apt_sources(), package)).succeeded
+
+
+def installed_packages(packages):
+    """Return the subset of packages that are installed, using a single dpkg-query"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        # unknown packages only produce a complaint on stderr, so the exit status is moot
+        out = run("dpkg-query -W -f='${Package}\\t${Status}\\n' %s" % ' '.join(packages))
+    found = set()
+    for line in out.splitlines():
+        fields = line.strip().split('\t')
+        if len(fields) == 2 and fields[1].endswith(' installed'):
+            found.add(fields[0])
+    return found
+
+
+def install_packages(groups=('base', 'postgres', 'redis', 'python', 'java')):
+    """Install whatever is missing from the given package groups in one apt transaction"""
+    wanted = []
+    for group in groups:
+        for package in package_groups[group]:
+            if package not in wanted:
+                wanted.append(package)
+    present = installed_packages(wanted)
+    missing = [p for p in wanted if p not in present]
+    if missing:
+        print("[%s] installing %s" % (env.host, ' '.join(missing)))
+        sudo('DEBIAN_FRONTEND=noninteractive apt-get -y %s install %s' % (apt_sources(), ' '.join(missing)))
+        # package versions and services have changed under the cached facts
+        invalidate_facts()
+    else:
+        print("[%s] all %d packages already installed" % (env.host, len(wanted)))
+    return missing
 
 
 def apt_update(force=False):
     if force or ((time.time() - int(run('stat -t /var/cache/apt/pkgcache.bin').split( )[12])) > 3600*24):
         sudo('apt-get update')
-
-
-def pip_install(packages):
-    if not exists('/usr/local/bin/pip'):
-        sudo('/usr/bin/easy_install pip')
-    sudo('pip install %s' % ' '.join(packages))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Host facts
+
+Gathers everything we need to know about a box (addresses, memory, CPUs, disks,
+package versions and service states) in a single remote call, and keeps it in
+an on-disk cache on the controller so later tasks and later runs can read it locally.
+"""
+
+import os, time
+from fabric.api import env, hide, settings
+from fabric.operations import run
+from .config import state_dir, load_json, save_json, facts as fact_settings
+
+cache_dir   = os.path.join(state_dir, 'facts')
+latency_dir = os.path.join(state_dir, 'latency')
+
+
+def fact_script():
+    """Shell snippet that prints every fact under a '### section' header"""
+    return '\n'.join([
+        "echo '### interfaces'",
+        "/sbin/ip -o -4 addr show | awk '{split($4, a, \"/\"); print $2, a[1]}'",
+        "echo '### memory'",
+        "awk '/^MemTotal:/ {print $2}' /proc/meminfo",
+        "echo '### cpus'",
+        "grep -c ^processor /proc/cpuinfo",
+        "echo '### disks'",
+        "lsblk -dnb -o NAME,ROTA,SIZE 2>/dev/null",
+        "echo '### mounts'",
+        "df -P -k | tail -n +2 | awk '{print $6, $2, $4}'",
+        "echo '### packages'",
+        "dpkg-query -W -f='${Package} ${Version} ${Status}\\n' | awk '$NF == \"installed\" {print $1, $2}'",
+        "echo '### services'",
+        "for s in %s; do" % ' '.join(fact_settings['services']),
+        "  if [ ! -x /etc/init.d/$s ]; then echo $s absent;",
+        "  elif /etc/init.d/$s status >/dev/null 2>&1; then echo $s running;",
+        "  else echo $s stopped; fi",
+        "done",
+    ])
+
+
+def parse_facts(output):
+    """Turn the sectioned output of fact_script() into a dictionary"""
+    sections, current = {}, None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('### '):
+            current = sections.setdefault(line[4:], [])
+        elif line and current is not None:
+            current.append(line.split())
+
+    facts = {
+        'interfaces': dict((f[0], f[1]) for f in sections.get('interfaces', []) if len(f) == 2),
+        'memory_mb' : int(sections['memory'][0][0]) / 1024 if sections.get('memory') else 0,
+        'cpus'      : int(sections['cpus'][0][0]) if sections.get('cpus') else 1,
+        'disks'     : {},
+        'mounts'    : {},
+        'packages'  : dict((f[0], f[1]) for f in sections.get('packages', []) if len(f) == 2),
+        'services'  : dict((f[0], f[1]) for f in sections.get('services', []) if len(f) == 2),
+    }
+    for name, rotational, size in (f for f in sections.get('disks', []) if len(f) == 3):
+        facts['disks'][name] = {'rotational': rotational == '1', 'size_mb': int(size) / (1024 * 1024)}
+    for mount, size, free in (f for f in sections.get('mounts', []) if len(f) == 3):
+        facts['mounts'][mount] = {'size_mb': int(size) / 1024, 'free_mb': int(free) / 1024}
+    return facts
+
+
+def cache_file(host):
+    return os.path.join(cache_dir, '%s.json' % host)
+
+
+def load_facts(host):
+    """Return cached facts for a host, or None if they are missing or stale"""
+    entry = load_json(cache_file(host))
+    if entry is None:
+        return None
+    if time.time() - entry['gathered'] > fact_settings['ttl']:
+        return None
+    return entry['facts']
+
+
+def save_facts(host, facts):
+    save_json(cache_file(host), {'gathered': time.time(), 'facts': facts})
+
+
+def save_latency(host, latency):
+    """Keep the round-trips measured from a host, so later runs render the same timing"""
+    save_json(os.path.join(latency_dir, '%s.json' % host), latency)
+
+
+def measured_latency():
+    """Round-trips per ensemble member: measured in this run, or else the last ones on record"""
+    latency = {}
+    for host in env.roledefs['production']:
+        measured = load_json(os.path.join(latency_dir, '%s.json' % host))
+        if measured is not None:
+            latency[host] = measured
+    latency.update(env.latency)
+    return latency
+
+
+def get_facts(refresh=False):
+    """Facts for the current host, from memory, the local cache or the host itself (in that order)"""
+    host = env.host
+    if not refresh:
+        if host in env.facts:
+            return env.facts[host]
+        facts = load_facts(host)
+        if facts is not None:
+            env.facts[host] = facts
+            return facts
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        facts = parse_facts(run(fact_script()))
+    save_facts(host, facts)
+    env.facts[host] = facts
+    return facts
+
+
+def gather_facts(refresh=False):
+    """Gather (or load cached) facts for a host"""
+    facts = get_facts(refresh=refresh in [True, 'True', 'true', '1', 'yes'])
+    print "[%s] %d MB RAM, %d CPUs, %s" % (env.host, facts['memory_mb'], facts['cpus'],
+        ', '.join('%s=%s' % i for i in sorted(facts['interfaces'].items())))
+    return facts
+
+
+def invalidate_facts():
+    """Drop cached facts for the current host (or every host, when run without one)"""
+    if env.host:
+        hosts = [env.host]
+    elif os.path.exists(cache_dir):
+        hosts = [f[:-5] for f in os.listdir(cache_dir) if f.endswith('.json')]
+    else:
+        hosts = []
+    for host in hosts:
+        env.facts.pop(host, None)
+        if os.path.exists(cache_file(host)):
+            os.remove(cache_file(host))
+            print "Dropped cached facts for %s" % host
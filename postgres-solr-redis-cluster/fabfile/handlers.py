@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Service handlers
+
+Tasks don't restart services themselves - they notify a handler when something
+the service depends on has changed, and every pending handler runs once per host
+when the handlers are flushed (at the end of a rollout, or on demand).
+
+Pending notifications are kept on the controller per host, so they survive the
+forked processes of parallel steps and are still there after a failed run.
+"""
+
+import os
+from fabric.api import env
+from .batch import Batch
+from .config import state_dir, load_json, save_json, services
+
+pending_dir = os.path.join(state_dir, 'handlers')
+
+# stronger actions win when a service is notified more than once
+precedence = ['reload', 'restart']
+
+
+def pending_file(host):
+    return os.path.join(pending_dir, '%s.json' % host)
+
+
+def pending(host=None):
+    """Notifications waiting to be handled on a host"""
+    return load_json(pending_file(host or env.host), {})
+
+
+def save_pending(host, actions):
+    path = pending_file(host)
+    if not actions:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    save_json(path, actions)
+
+
+def notify(service, action='restart'):
+    """Ask for a service to be restarted (or reloaded, if its settings allow it) when handlers are flushed"""
+    if action == 'reload' and not services.get(service, {}).get('reload'):
+        action = 'restart'
+    actions = pending()
+    if precedence.index(action) >= precedence.index(actions.get(service, action)):
+        actions[service] = action
+    save_pending(env.host, actions)
+    print "[%s] %s: %s pending" % (env.host, service, actions[service])
+
+
+def forget(service):
+    """Drop a pending notification, for tasks that have just restarted the service themselves"""
+    actions = pending()
+    if actions.pop(service, None):
+        save_pending(env.host, actions)
+
+
+def flush_handlers(*only):
+    """Run pending restarts/reloads on the current host, once per service"""
+    actions = pending()
+    todo = sorted(s for s in actions if not only or s in only)
+    if not todo:
+        return {}
+    with Batch() as b:
+        for service in todo:
+            b.sudo('service %s %s' % (service, actions[service]))
+    done = dict((s, actions.pop(s)) for s in todo)
+    save_pending(env.host, actions)
+    for service in todo:
+        print "[%s] %s: %s done" % (env.host, service, done[service])
+    return done
@@ -6,61 +6,64 @@ Generic helpers
 Created by: Rui Carmo
 """
 
-from fabric.api import env, local, hosts, roles, shell_env
+from fabric.api import env, local, hosts, roles, shell_env, cd
 from fabric.operations import run, sudo, put, hide, settings
-from fabric.contrib.files import contains, exists, cd, append, comment
+from fabric.contrib.files import contains, exists, append, comment
 from StringIO import StringIO
+from .facts import get_facts
+from .batch import Batch
+from .sql import Session
+from .artifacts import fetch, push_artifact, remote_path
 
 def inject_files(files):
-    for f in files:
-        if not exists(f):
-            put(StringIO(files[f]), f, use_sudo = True)
-            sudo('chmod 0644 %s' % f)
-            sudo('chown root:root %s' % f)
+    with Batch() as b:
+        for f in files:
+            b.put(files[f], f, perms='0644', owner='root:root', only_if_missing=True)
 
 
-def tarball(url=None, target='/tmp', ext="tar.gz"):
+def tarball(url=None, target='/tmp', ext="tar.gz", sha256=None):
+    """Unpack a tarball from the artifact cache, pushing it from the controller if the host lacks it"""
     if url:
-        package = '/tmp/package.%s' % ext
-        if 'development' not in env.roles:
-            with shell_env(
-                # we need a proxy to reach outside the prod environment
-                http_proxy  = 'http://proxy:8080',
-                https_proxy ='http://proxy:8080'
-            ):
-                run('wget --no-check-certificate -O %s "%s"' % (package,url))
-        else:
-            run('wget --no-check-certificate -O %s "%s"' % (package,url))
-
+        checksum = fetch(url)
+        push_artifact(checksum)
         if not exists(target):
             sudo('mkdir -p ' + target)
-        sudo('tar -zxvf %s -C %s' % (package, target))
+        sudo('tar -zxf %s -C %s' % (remote_path(checksum), target))
 
 
 def get_interface_address(intf='eth0'):
     """Obtain the IP address of a given interface on a host"""
-    with hide('running','output', 'warnings'):
-        return run('/sbin/ifconfig %s | grep "inet addr"' % intf).strip().split('  ')[0].split(':')[1]
+    return get_facts()['interfaces'][intf]
 
 
 @roles('production')
 def collect_ip_addresses(intf='eth0'):
-    """Maintain a local cache of IP addresses"""
+    """Maintain a local cache of IP addresses (backed by the host fact cache)"""
     print "Getting IP address for %s" % env.host
     if env.host not in env.addresses:
         env.addresses[env.host] = {}
     if intf not in env.addresses[env.host]:
-        env.addresses[env.host][intf] = get_interface_address(intf)
+        env.addresses[env.host].update(get_facts()['interfaces'])
+    if intf not in env.addresses[env.host]:
+        # the cache may predate the interface coming up
+        env.addresses[env.host].update(get_facts(refresh=True)['interfaces'])
+    return env.addresses[env.host]
 
 
-def psql(command):
+def psql(command, database='postgres'):
     """Issue SQL commands to Postgres"""
-    if type(command) == list:
-        command = '\n'.join(command)
-    with hide('running','output', 'warnings'):
-        put(StringIO(command),'/tmp/psql.sql', use_sudo = True)
-    print "[%s] psql %s" % (env.host,command)
+    if type(command) != list:
+        command = [command]
+    print "[%s] psql %s" % (env.host, '\n'.join(command))
+    with Session(database) as s:
+        for statement in command:
+            s.run(statement)
+    return s.results[-1]
+
+
+def psql_query(sql, database='postgres'):
+    """Run a query as postgres, returning its rows as tuples of strings"""
     with hide('running'):
-        sudo("""bash -c \'su - postgres -s /usr/bin/psql postgres postgres < /tmp/psql.sql\'""")
-    with hide('running','output', 'warnings'):
-        sudo('rm -f /tmp/psql.sql')
+        with Session(database) as s:
+            s.run(sql)
+    return s.results[0].rows
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deploy journal
+
+Records, per host, a hash of everything each converging task depends on (the
+config sections it renders from, the package lists, tarball specs, the task's own
+code and the host's facts), plus a fingerprint of the host taken at the end of
+the last rollout (checksums of every managed file, installed package versions
+and service states).
+
+A rollout skips a task on a host when both are unchanged, so re-running a
+converged cluster costs one probe per host. Run with `--set force` to ignore
+the journal, or `--set plan` to only print what would run.
+"""
+
+import os, sys, json
+from hashlib import sha1
+from fabric.api import env, hide, settings
+from fabric.operations import sudo
+from .batch import quote
+from .managed import pushed_dir
+from .tuning import zookeeper_timing
+from .facts import measured_latency, load_facts
+from .config import state_dir, load_json, save_json, packages, services
+from . import config
+
+journal_dir = os.path.join(state_dir, 'journal')
+
+
+def latency_timing():
+    """ZooKeeper's timing only changes when the measured round-trips move it to another tick"""
+    return zookeeper_timing([ms for peers in measured_latency().values() for ms in peers.values()])
+
+
+# what each journaled task depends on besides its code and the host's facts: config
+# sections by name, or callables for values worked out at run time. Tasks that are
+# not listed (fact gathering, handlers, reports) always run
+inputs = {
+    'setup_host'             : ['repos', 'packages', 'configuration_files', 'apt_bundle'],
+    'install_apt_bundle'     : ['packages', 'repos', 'apt_bundle'],
+    'install_wheelhouse'     : ['packages', 'wheelhouse'],
+    'rebind_postgres'        : ['postgres', 'pgbouncer'],
+    'setup_database'         : ['postgres'],
+    'setup_master'           : ['postgres', 'pgbouncer'],
+    'setup_slaves'           : ['postgres', 'pgbouncer'],
+    'setup_pgbouncer'        : ['postgres', 'pgbouncer'],
+    'rebind_redis'           : ['redis'],
+    'lockdown_redis'         : ['redis'],
+    # redis and solr are sized from what the other services leave over
+    'tune_redis'             : ['redis', 'postgres', 'zookeeper'],
+    'setup_sentinel'         : ['redis'],
+    'unpack_solr'            : ['tarballs'],
+    'setup_solr_service'     : ['solr', 'postgres', 'redis', 'zookeeper', 'tarballs'],
+    'setup_solr_master'      : ['solr'],
+    'setup_solr_slave'       : ['solr'],
+    'unpack_zookeeper'       : ['tarballs'],
+    'setup_zookeeper_service': ['zookeeper', 'tarballs', latency_timing],
+}
+
+
+def journal_file(host):
+    return os.path.join(journal_dir, '%s.json' % host)
+
+
+def load_journal(host):
+    return load_json(journal_file(host), {'state': None, 'tasks': {}})
+
+
+def save_journal(host, entry):
+    save_json(journal_file(host), entry)
+
+
+def source_of(task):
+    with open(sys.modules[task.__module__].__file__.replace('.pyc', '.py')) as f:
+        return f.read()
+
+
+def inputs_hash(task, host, kwargs, peers):
+    """Hash of a task's inputs on a host, or None if the task isn't journaled"""
+    names = inputs.get(task.__name__)
+    if names is None:
+        return None
+    facts = env.facts.get(host, {})
+    values = [n() if callable(n) else getattr(config, n) for n in names]
+    if 'postgres' in names:
+        # max_connections adds up the pgbouncer pools of every box, so resizing any box
+        # changes whatever is sized from the postgres settings everywhere else
+        values.append(sorted((h, [(env.facts.get(h) or load_facts(h) or {}).get(k) for k in ['memory_mb', 'cpus']])
+                             for h in env.roledefs['production']))
+    # bindings and replication settings name every peer, so their addresses count too
+    peers = sorted((h, env.facts.get(h, {}).get('interfaces')) for h in peers)
+    digest = sha1(json.dumps([values, kwargs, peers, dict((k, facts.get(k)) for k in ['memory_mb', 'cpus', 'disks'])],
+                             sort_keys=True, default=str))
+    digest.update(source_of(task))
+    return digest.hexdigest()
+
+
+def managed_paths(host):
+    """Remote paths of every file we have pushed to a host"""
+    path = os.path.join(pushed_dir, host)
+    return sorted('/' + name.replace('%', '/') for name in os.listdir(path)) if os.path.isdir(path) else []
+
+
+def remote_state():
+    """Fingerprint the current host in one call: managed file checksums, package versions and service states"""
+    paths = managed_paths(env.host)
+    names = sorted(set(p for group in packages.values() for p in group if '==' not in p))
+    script = '; '.join([
+        'md5sum %s 2>/dev/null' % ' '.join(quote(p) for p in paths) if paths else 'true',
+        "dpkg-query -W -f='${Package} ${Version}\\n' %s 2>/dev/null" % ' '.join(names),
+        'for s in %s; do [ -x /etc/init.d/$s ] && { /etc/init.d/$s status >/dev/null 2>&1 && echo $s up || echo $s down; }; done'
+        % ' '.join(sorted(services)),
+        'true'
+    ])
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo(script)
+    return sha1('\n'.join(sorted(out.replace('\r\n', '\n').split('\n')))).hexdigest()
+
+
+def unchanged(host, name, digest, state):
+    """True when the journal says this exact task already converged on a host that hasn't moved since"""
+    entry = load_journal(host)
+    return digest is not None and state is not None and entry['state'] == state and entry['tasks'].get(name) == digest
+
+
+def record_tasks(host, digests):
+    """Remember the inputs of tasks that just succeeded on a host"""
+    entry = load_journal(host)
+    entry['tasks'].update(digests)
+    save_journal(host, entry)
+
+
+def record_state(host, state):
+    entry = load_journal(host)
+    entry['state'] = state
+    save_journal(host, entry)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Managed configuration files
+
+Config files are rendered in full on the controller from ordered settings, and
+only pushed when their checksum differs from the copy on the host. A single
+md5sum call covers every file a task manages, so re-running a converged task
+costs one round-trip.
+"""
+
+import os
+from hashlib import md5
+from fabric.api import env, hide, settings
+from fabric.operations import sudo
+from .batch import Batch, quote
+from .config import state_dir
+
+# last content pushed to each host, used to work out which settings changed
+pushed_dir = os.path.join(state_dir, 'configs')
+
+header = "# Managed by fabric - local changes will be overwritten\n"
+
+
+def postgres_value(value):
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def render(values, style='properties'):
+    """Render an ordered mapping of settings into a config file.
+
+    Styles are 'postgres' (key = 'value'), 'redis' (key value, lists repeat the key)
+    and 'properties' (key=value, which also covers shell defaults files)."""
+    lines = [header]
+    for key, value in values.items():
+        if value is None:
+            continue
+        for item in (value if isinstance(value, list) else [value]):
+            if style == 'postgres':
+                lines.append("%s = %s\n" % (key, postgres_value(item)))
+            elif style == 'redis':
+                lines.append("%s %s\n" % (key, item))
+            else:
+                lines.append("%s=%s\n" % (key, item))
+    return ''.join(lines)
+
+
+def render_ini(sections, style='properties'):
+    """Render an ordered mapping of section name -> settings as an ini file"""
+    parts = [header]
+    for section, values in sections.items():
+        parts.append('\n[%s]\n' % section)
+        parts.append(render(values, style)[len(header):])
+    return ''.join(parts)
+
+
+def checksum(content):
+    return md5(content).hexdigest()
+
+
+def pushed_file(path):
+    return os.path.join(pushed_dir, env.host, path.strip('/').replace('/', '%'))
+
+
+def last_pushed(path):
+    """Content we last pushed to (or found on) the current host, or None if unknown"""
+    try:
+        with open(pushed_file(path)) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def remember(path, content):
+    local_path = pushed_file(path)
+    if not os.path.exists(os.path.dirname(local_path)):
+        os.makedirs(os.path.dirname(local_path))
+    with open(local_path, 'w') as f:
+        f.write(content)
+
+
+def parse_settings(content, separator='='):
+    """Read back key/value pairs from a rendered file, for comparing two renderings"""
+    values = {}
+    for line in (content or '').splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            key, _, value = line.partition(separator) if separator else line.partition(' ')
+            values[key.strip()] = value.strip()
+    return values
+
+
+def changed_settings(path, content, separator='='):
+    """Keys whose value differs between the last pushed copy of a file and a new rendering"""
+    old, new = parse_settings(last_pushed(path), separator), parse_settings(content, separator)
+    return set(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+def remote_checksums(paths):
+    """Fetch the md5 of several remote files in one call (missing files are left out)"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo('md5sum %s 2>/dev/null' % ' '.join(quote(p) for p in paths))
+    sums = {}
+    for line in out.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) == 2 and fields[1] in paths:
+            sums[fields[1]] = fields[0]
+    return sums
+
+
+def sync_configs(files):
+    """Push each (path, content, owner, perms) whose remote checksum differs, returning the changed paths"""
+    remote = remote_checksums([f[0] for f in files])
+    changed = [f for f in files if remote.get(f[0]) != checksum(f[1])]
+    if changed:
+        with Batch() as b:
+            for path, content, owner, perms in changed:
+                b.put(content, path, perms=perms, owner=owner)
+        for f in changed:
+            print "[%s] updated %s" % (env.host, f[0])
+    for path, content, owner, perms in files:
+        remember(path, content)
+    return [f[0] for f in changed]
+
+
+def sync_config(path, content, owner='root:root', perms='0644'):
+    """Push a single file if it changed, returning True when it did"""
+    return bool(sync_configs([(path, content, owner, perms)]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PgBouncer Configuration
+
+Transaction-mode connection pooling on every box, so short-lived app and worker
+connections share a small set of Postgres backends. Writes go to the master and
+reads to the standby on the same box.
+"""
+
+from collections import OrderedDict
+from hashlib import md5
+from fabric.api import env, roles
+from fabric.operations import sudo
+from .debian import install_packages
+from .facts import get_facts
+from .tuning import pgbouncer_pools
+from .managed import render, render_ini, sync_configs
+from .handlers import notify, forget
+from .config import postgres, pgbouncer
+
+config_dir    = '/etc/pgbouncer'
+ini_file      = config_dir + '/pgbouncer.ini'
+userlist_file = config_dir + '/userlist.txt'
+defaults_file = '/etc/default/pgbouncer'
+
+
+def pgbouncer_ini(intf='eth0'):
+    """Render pgbouncer.ini with pool sizes derived from this box's core count"""
+    master = env.roledefs['master'][0]
+    if master not in env.addresses:
+        raise KeyError("could not find master IP address")
+    pools = pgbouncer_pools(get_facts(), pgbouncer['pool_per_core'])
+    database = postgres['database']
+    return render_ini(OrderedDict([
+        ('databases', OrderedDict([
+            (database,         'host=%s port=5432 dbname=%s' % (env.addresses[master][intf], database)),
+            (database + '_ro', 'host=127.0.0.1 port=5432 dbname=%s' % database),
+        ])),
+        ('pgbouncer', OrderedDict([
+            ('listen_addr',               '*'),
+            ('listen_port',               pgbouncer['port']),
+            ('unix_socket_dir',           '/var/run/postgresql'),
+            ('auth_type',                 'md5'),
+            ('auth_file',                 userlist_file),
+            ('admin_users',               'postgres'),
+            ('pool_mode',                 pgbouncer['pool_mode']),
+            ('max_client_conn',           pgbouncer['max_client_conn']),
+            ('default_pool_size',         pools['default_pool_size']),
+            ('reserve_pool_size',         pools['reserve_pool_size']),
+            ('reserve_pool_timeout',      3),
+            ('server_idle_timeout',       60),
+            # psycopg2 sends this on connect, and pgbouncer refuses unknown parameters
+            ('ignore_startup_parameters', 'extra_float_digits'),
+            ('logfile',                   '/var/log/postgresql/pgbouncer.log'),
+            ('pidfile',                   '/var/run/postgresql/pgbouncer.pid'),
+        ])),
+    ]))
+
+
+def userlist():
+    user, password = postgres['user'], postgres['password']
+    return '"%s" "md5%s"\n' % (user, md5(password + user).hexdigest())
+
+
+def configure_pgbouncer():
+    """Push pgbouncer's files, returning the paths that changed"""
+    return sync_configs([
+        (ini_file,      pgbouncer_ini(),                      'postgres:postgres', '0640'),
+        (userlist_file, userlist(),                           'postgres:postgres', '0640'),
+        (defaults_file, render(OrderedDict([('START', 1)])),  'root:root',         '0644'),
+    ])
+
+
+@roles('production')
+def setup_pgbouncer():
+    """Install and configure pgbouncer on a box"""
+    install_packages(['pgbouncer'])
+    changed = configure_pgbouncer()
+    if defaults_file in changed:
+        # first enabled by us, so it isn't running yet
+        notify('pgbouncer', 'restart')
+    elif changed:
+        notify('pgbouncer', 'reload')
+
+
+@roles('production')
+def reload_pgbouncer():
+    """Re-render the pool configuration and reload it in place, keeping client connections"""
+    configure_pgbouncer()
+    sudo('service pgbouncer reload')
+    forget('pgbouncer')
@@ -11,10 +11,18 @@ Created by: Rui Carmo
 """
 
 import os, sys, time
-from fabric.api import env, local, hosts, roles
+from collections import OrderedDict
+from fabric.api import env, local, hosts, roles, cd, execute, abort
 from fabric.operations import run, sudo, put, hide, settings
-from fabric.contrib.files import contains, exists, cd, append, comment
-from .helpers import psql, collect_ip_addresses
+from fabric.contrib.files import contains, exists, append, comment
+from .helpers import psql, psql_query, collect_ip_addresses
+from .sql import Session, literal, duplicate_object, duplicate_database
+from .facts import get_facts, load_facts
+from .tuning import postgres_tuning, pgbouncer_pools, to_kb
+from .managed import render, sync_configs, header, changed_settings
+from .handlers import notify, forget
+from .rollout import fan_out, run_step
+from .config import postgres, pgbouncer
 
 prefix        = '/etc/postgresql/9.2/main/%s'
 pg_conf       = prefix % 'postgresql.conf'
@@ -22,76 +30,266 @@ hba_conf      = prefix % 'pg_hba.conf'
 data_path     = '/var/lib/postgresql/9.2/main'
 recovery_conf = data_path + '/recovery.conf'
 
+# settings that only take effect when the postmaster restarts - anything else is a reload
+restart_settings = set([
+    'data_directory', 'hba_file', 'ident_file', 'external_pid_file', 'listen_addresses',
+    'port', 'max_connections', 'unix_socket_directory', 'ssl', 'shared_buffers',
+    'wal_level', 'wal_buffers', 'max_wal_senders', 'hot_standby', 'max_prepared_transactions',
+    'max_locks_per_transaction', 'shared_preload_libraries', 'autovacuum_max_workers',
+    'max_worker_processes',
+])
+
+shm_conf      = '/etc/sysctl.d/30-postgresql-shm.conf'
+
+
+
+def max_connections():
+    """With pgbouncer in front, size max_connections to the pools that can point at this box.
+
+    Every box pools writes to the master and reads to its local server, so the
+    worst case is the master taking both pools from every box. Standbys get the
+    same figure, since 9.x refuses to run a hot standby below the master's value."""
+    if not pgbouncer['enabled']:
+        return postgres['max_connections']
+    total = 0
+    for host in env.roledefs['production']:
+        facts = env.facts.get(host) or load_facts(host)
+        if not facts:
+            # never stand in the current box's facts - every box has to arrive at the same figure
+            facts = env.facts[host] = execute(get_facts, hosts=[host])[host]
+        pools = pgbouncer_pools(facts, pgbouncer['pool_per_core'])
+        total += 2 * (pools['default_pool_size'] + pools['reserve_pool_size'])
+    return total + pgbouncer['headroom']
+
+
+def tuning(workload=None):
+    """Hardware-derived settings for the current host"""
+    return postgres_tuning(get_facts(), workload or postgres['workload'],
+                           max_connections(), postgres['version'])
+
+
+def shm_sysctl():
+    """Before 9.3 shared_buffers lives in SysV shared memory, so the kernel limits must fit it"""
+    ram = get_facts()['memory_mb'] * 1024 * 1024
+    return render(OrderedDict([
+        ('kernel.shmmax', ram / 2),
+        ('kernel.shmall', ram / 2 / 4096),
+    ]), 'postgres')
+
+
+def postgresql_conf(intf='eth0'):
+    """Render the full postgresql.conf for the current host"""
+    conf = OrderedDict([
+        ('data_directory',            data_path),
+        ('hba_file',                  hba_conf),
+        ('ident_file',                prefix % 'pg_ident.conf'),
+        ('external_pid_file',         '/var/run/postgresql/9.2-main.pid'),
+        ('listen_addresses',          'localhost,%s' % env.addresses[env.host][intf]),
+        ('port',                      5432),
+        ('max_connections',           max_connections()),
+        ('unix_socket_directory',     '/var/run/postgresql'),
+        ('ssl',                       True),
+        ('wal_level',                 'hot_standby'),
+        ('max_wal_senders',           5),
+        ('wal_keep_segments',         32),
+        ('hot_standby',               env.host in env.roledefs['slaves']),
+        ('log_line_prefix',           '%t '),
+        ('datestyle',                 'iso, mdy'),
+        ('lc_messages',               postgres['locale']),
+        ('lc_monetary',               postgres['locale']),
+        ('lc_numeric',                postgres['locale']),
+        ('lc_time',                   postgres['locale']),
+        ('default_text_search_config','pg_catalog.english'),
+    ])
+    conf.update(tuning())
+    return render(conf, 'postgres')
+
+
+def pg_hba_conf(intf='eth0'):
+    """Render pg_hba.conf, letting every production box (this one included, for pgbouncer) replicate and connect"""
+    lines = [
+        'local   all           postgres                  peer',
+        'local   all           all                       peer',
+        'host    all           all         127.0.0.1/32  md5',
+        'host    all           all         ::1/128       md5',
+    ]
+    for host in env.roledefs['production']:
+        if host not in env.addresses:
+            raise KeyError("could not find IP address for %s" % host)
+        lines.append('host    replication   all         %s/32  trust' % env.addresses[host][intf])
+        lines.append('host    all           all         %s/32  md5' % env.addresses[host][intf])
+    return header + '\n'.join(lines) + '\n'
+
+
+def recovery_conf_for(master_ip):
+    return render(OrderedDict([
+        ('standby_mode',     True),
+        ('primary_conninfo', 'host=%s user=%s' % (master_ip, postgres['user'])),
+    ]), 'postgres')
+
+
+def configure_postgres(intf='eth0'):
+    """Push postgresql.conf and pg_hba.conf, then ask for a reload or restart depending on what changed"""
+    conf = postgresql_conf(intf)
+    keys = changed_settings(pg_conf, conf)
+    if tuple(int(v) for v in postgres['version'].split('.')) < (9, 3):
+        if sync_configs([(shm_conf, shm_sysctl(), 'root:root', '0644')]):
+            sudo('sysctl -p %s' % shm_conf)
+    changed = sync_configs([
+        (pg_conf,  conf,              'postgres:postgres', '0644'),
+        (hba_conf, pg_hba_conf(intf), 'postgres:postgres', '0640'),
+    ])
+    if pg_conf in changed and keys & restart_settings:
+        notify('postgresql', 'restart')
+    elif changed:
+        notify('postgresql', 'reload')
+    return changed
+
+
+@roles('production')
+def show_tuning(workload=None):
+    """Compare the running settings with what the tuning profile would set"""
+    proposed = tuning(workload)
+    rows = psql_query("SELECT name, setting, coalesce(unit, '') FROM pg_settings WHERE name IN (%s);" %
+                      ', '.join("'%s'" % k for k in proposed))
+    current = dict((r[0], (r[1], r[2] or None)) for r in rows if len(r) == 3)
+    facts = get_facts()
+    print "\n[%s] %d MB RAM, %d CPUs, %s profile" % (env.host, facts['memory_mb'], facts['cpus'], workload or postgres['workload'])
+    for name, value in proposed.items():
+        setting, unit = current.get(name, ('(unset)', None))
+        same = to_kb(setting, unit) == to_kb(value)
+        print "  %s %-32s %16s -> %s" % (' ' if same else '*', name, setting + (unit or ''), value)
+    return proposed
+
 
 @roles('production')
 def rebind_postgres(intf='eth0'):
     """Bind postgres to eth0 besides localhost"""
     collect_ip_addresses(intf)
-    if not contains(pg_conf,'^listen_addresses'):
-        append(pg_conf,"listen_addresses = 'localhost,%s'" % env.addresses[env.host][intf], use_sudo = True)
-        sudo('service postgresql restart')
+    configure_postgres(intf)
 
 
 def setup_database():
     """Create the application database and associated user with a temporary password"""
-    with hide('output', 'running'):
-        with settings(warn_only=True):
-            psql("CREATE USER project UNENCRYPTED PASSWORD 'project';")
-            psql("ALTER ROLE project REPLICATION LOGIN;")
-        with settings(warn_only=True):
-            psql("CREATE DATABASE project ENCODING 'UTF-8';")
-        psql("GRANT ALL ON DATABASE project TO project;")
+    database, user = postgres['database'], postgres['user']
+    with hide('running'):
+        with Session() as s:
+            s.run("CREATE USER %s UNENCRYPTED PASSWORD %s;" % (user, literal(postgres['password'])), ignore=[duplicate_object])
+            s.run("ALTER ROLE %s REPLICATION LOGIN;" % user)
+            # CREATE DATABASE can't run inside a transaction, so this is a plain session
+            s.run("CREATE DATABASE %s ENCODING 'UTF-8';" % database, ignore=[duplicate_database])
+            s.run("GRANT ALL ON DATABASE %s TO %s;" % (database, user))
+    print "[%s] database ready (%d statements, %.2fs)" % (env.host, len(s.results), s.seconds)
+    return [(r.sql, r.code) for r in s.results if r.failed]
 
 
 def setup_master():
     print "Setting up master %s" % env.host
-    sudo('service postgresql stop')
-    append(pg_conf, 'wal_level = hot_standby', use_sudo = True)
-    append(pg_conf, 'max_wal_senders = 5', use_sudo = True)
-    append(pg_conf, 'wal_keep_segments = 32', use_sudo = True)
-    append(pg_conf, 'max_connections = 1000', use_sudo = True)
-
-    if not contains(hba_conf, 'replication'):
-        for host in env.roledefs['slaves']:
-            if host not in env.addresses:
-                raise KeyError("could not find slave IP address")
-            append(hba_conf, 'host  replication   all   %s/32      trust' % env.addresses[host]['eth0'], use_sudo = True)
-            append(hba_conf, 'host  all   all   %s/32      md5' % env.addresses[host]['eth0'], use_sudo = True)
+    configure_postgres()
 
-    sudo('service postgresql start')
+
+def master_address(intf='eth0'):
+    host = env.roledefs['master'][0]
+    if host not in env.addresses:
+        raise KeyError("could not find master IP address")
+    return env.addresses[host][intf]
 
 
-def setup_slaves():
-    print "Setting up slave %s" % env.host
+def is_streaming_standby():
+    """True if postgres is up and recovering from a recovery.conf we put there"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        if sudo('test -f %s' % recovery_conf).failed:
+            return False
+        with Session() as s:
+            s.run('SELECT pg_is_in_recovery();')
+    return s.results[0].scalar() == 't'
+
+
+def seed_replica(mode='basebackup', compress=None):
+    """(Re)build the current slave's data directory from the master and start it as a standby.
+
+    'basebackup' copies the whole cluster with pg_basebackup (optionally over a
+    compressed SSL link), while 'rsync' only copies files that differ and expects
+    the master to be in backup mode (see rsync_data). Returns transfer statistics."""
+    compress = postgres['seed_compress'] if compress is None else compress in [True, 'True', 'true', '1', 'yes']
+    master_ip = master_address()
     with settings(warn_only=True):
         sudo('service postgresql stop')
+    configure_postgres()
 
-    host = env.roledefs['master'][0]
-    if host not in env.addresses:
-        raise KeyError("could not find master IP address")
-    print host
-    master_ip = env.addresses[host]['eth0']
-
-    append(pg_conf, 'wal_level = hot_standby', use_sudo = True)
-    append(pg_conf, 'max_wal_senders = 5', use_sudo = True)
-    append(pg_conf, 'wal_keep_segments = 32', use_sudo = True)
-    append(pg_conf, 'hot_standby = on', use_sudo = True)
-    
+    start = time.time()
     with cd(os.path.dirname(data_path)):
-        with settings(warn_only=True):
-            sudo('mv main main.%d' % time.time() )
-        print "Starting backup from master %s" % master_ip
-        sudo('pg_basebackup -P -x -h %s -U project -D main' % master_ip)
-        sudo('rm -f main/backup_label')
-        sudo('chown -R postgres:postgres main')
-        print "Done."
-    append(recovery_conf, "standby_mode = 'on'", use_sudo = True)
-    append(recovery_conf, "primary_conninfo = 'host=%s user=project'" % master_ip, use_sudo = True)
+        if mode == 'rsync':
+            # pull as postgres, so the postgres user's key on the master is what authorises it
+            with settings(warn_only=True):
+                out = sudo('rsync -a --delete --stats %s --exclude postmaster.pid --exclude postmaster.opts '
+                           '--exclude recovery.conf --exclude "pg_xlog/*" postgres@%s:%s/ main/' % (
+                           '-z' if compress else '', master_ip, data_path), user='postgres')
+            # 24 means files vanished mid-copy, which is routine while the master is running
+            if out.return_code not in (0, 24):
+                abort("[%s] rsync from the master failed with exit code %d" % (env.host, out.return_code))
+            stats = dict(l.split(': ', 1) for l in out.splitlines() if ': ' in l)
+            transferred = int(stats.get('Total transferred file size', '0').split()[0].replace(',', ''))
+            total = int(stats.get('Total file size', '0').split()[0].replace(',', ''))
+        else:
+            with settings(warn_only=True):
+                sudo('mv main main.%d' % time.time())
+            print "[%s] starting base backup from master %s%s" % (env.host, master_ip, ' (compressed)' if compress else '')
+            ssl = 'PGSSLMODE=require PGSSLCOMPRESSION=1 ' if compress else ''
+            sudo('%spg_basebackup -P -x -h %s -U %s -D main' % (ssl, master_ip, postgres['user']))
+            sudo('chown -R postgres:postgres main')
+            with hide('running', 'output'):
+                transferred = total = int(sudo('du -sb main').split()[0])
+    elapsed = max(time.time() - start, 0.001)
+
+    sync_configs([(recovery_conf, recovery_conf_for(master_ip), 'postgres:postgres', '0644')])
     sudo('service postgresql start')
+    # the stop/start above already picked up any pending configuration change
+    forget('postgresql')
+    report = {
+        'mode'       : mode,
+        'transferred': transferred,
+        'total'      : total,
+        'seconds'    : round(elapsed, 1),
+        'mb_per_sec' : round(transferred / elapsed / 1048576, 1),
+    }
+    print "[%s] %s: %d of %d MB copied in %.1fs (%.1f MB/s)" % (env.host, mode,
+        transferred / 1048576, total / 1048576, elapsed, report['mb_per_sec'])
+    return report
+
+
+def setup_slaves(force=False):
+    """Seed a slave from the master, unless it is already streaming from it"""
+    print "Setting up slave %s" % env.host
+    if not force and is_streaming_standby():
+        configure_postgres()
+        sync_configs([(recovery_conf, recovery_conf_for(master_address()), 'postgres:postgres', '0644')])
+        print "[%s] already streaming from the master, not re-seeding" % env.host
+        return
+    return seed_replica('basebackup')
 
 
 @roles('master')
-def rsync_data():
-    """Unfinished stub for replicating data to new members of the cluster"""
+def rsync_data(compress=None):
+    """Re-sync every slave from the master in parallel, copying only the files that changed"""
     print "Syncing data to slaves"
-    #rsync -av --rsync-path="sudo rsync" --exclude pg_xlog --exclude postgresql.conf /var/lib/* 192.168.0.1:/var/lib/postgresql/data/
+    run_step(collect_ip_addresses, 'production')
+    with hide('output'):
+        psql("SELECT pg_start_backup('rsync_data', true);")
+    try:
+        results = fan_out(seed_replica, 'slaves', 'rsync', compress)
+    finally:
+        with hide('output'):
+            psql("SELECT pg_stop_backup();")
+    print_seeding_report(results)
+    return results
+
+
+def print_seeding_report(results):
+    print "\nReplica seeding"
+    for host in sorted(results):
+        r = results[host]
+        if isinstance(r, dict):
+            print "  %-20s %-10s %8d MB %8.1fs %8.1f MB/s" % (host, r['mode'], r['transferred'] / 1048576, r['seconds'], r['mb_per_sec'])
+        else:
+            print "  %-20s %s" % (host, r)
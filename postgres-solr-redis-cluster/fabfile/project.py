@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Project releases
+
+The project tree is packed once on the controller into a reproducible tarball,
+which goes through the artifact cache like any other tarball (pushed to the
+master, pulled by the slaves in parallel). Every box unpacks it into a release
+directory of its own, hardlinking files that are unchanged from the live release
+so they take no extra disk. Only once every box holds the new release is the
+`current` symlink swapped with a rename and gunicorn reloaded gracefully, so it
+never sees a half-copied tree. The previous release is kept for rollback.
+"""
+
+import os, gzip, tarfile, tempfile
+from fnmatch import fnmatch
+from datetime import datetime
+from fabric.api import env, hide, settings, abort
+from fabric.operations import sudo
+from .batch import Batch
+from .artifacts import cache_dir, add_artifact, spread_artifacts, local_path, remote_path, remote_dir
+from .rollout import fan_out, Failure
+from .config import state_dir, load_json, save_json, project
+
+releases_dir = project['remote_dir'] + '/releases'
+current      = project['remote_dir'] + '/current'
+previous     = project['remote_dir'] + '/previous'
+marker       = '.artifact'
+index_file   = os.path.join(state_dir, 'project.json')
+
+
+def excluded(path):
+    return any(fnmatch(part, pattern) for part in path.split(os.sep) for pattern in project['exclude'])
+
+
+def pack_tree(local_dir):
+    """Tar and gzip a tree with sorted entries, fixed ownership and no timestamp in the gzip
+    header, so the same tree always packs to the same checksum"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    handle, path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(handle, 'wb') as out:
+        archive = tarfile.open(fileobj=gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0), mode='w')
+        for root, dirs, files in os.walk(local_dir):
+            dirs[:] = sorted(d for d in dirs if not excluded(d))
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                relative = os.path.relpath(full, local_dir)
+                if excluded(relative):
+                    continue
+                info = archive.gettarinfo(full, relative)
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                if info.isreg():
+                    with open(full, 'rb') as f:
+                        archive.addfile(info, f)
+                else:
+                    archive.addfile(info)
+        archive.close()
+        archive.fileobj.close()
+    return add_artifact(path)
+
+
+def live_artifact():
+    """Checksum of the artifact the current host is running, if it has a release live"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo('cat %s/%s' % (current, marker))
+    return out.strip() if out.succeeded else None
+
+
+def unpack_release(checksum, release):
+    """Unpack a release next to the live one, hardlinking every file the live release already has"""
+    if live_artifact() == checksum:
+        return False
+    target = '%s/%s' % (releases_dir, release)
+    with Batch() as b:
+        b.sudo('mkdir -p %s && rm -rf %s.unpack %s.tmp' % (releases_dir, target, target))
+        b.sudo('mkdir %s.unpack && tar -xzf %s -C %s.unpack' % (target, remote_path(checksum), target))
+        # rsync only copies what differs from the live release and hardlinks the rest
+        b.sudo('if [ -d %s/ ]; then rsync -a --link-dest=$(readlink -f %s)/ %s.unpack/ %s.tmp/; '
+               'else mv -T %s.unpack %s.tmp; fi' % (current, current, target, target, target, target))
+        b.sudo('echo %s > %s.tmp/%s && rm -rf %s.unpack %s && mv -T %s.tmp %s' % (
+            checksum, target, marker, target, target, target, target))
+    return True
+
+
+def reload_gunicorn():
+    """Graceful reload: the gunicorn master starts new workers on the new code and lets the old ones finish"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        return sudo('[ -f %s ] && kill -%s $(cat %s)' % (
+            project['pidfile'], project['reload_signal'], project['pidfile'])).succeeded
+
+
+def switch_release(release):
+    """Point `current` at a release with a single rename, keeping the old target as `previous`"""
+    with Batch() as b:
+        b.sudo('if [ -L %s ]; then ln -sfn $(readlink %s) %s.new && mv -T %s.new %s; fi' % (
+            current, current, previous, previous, previous))
+        b.sudo('ln -sfn %s/%s %s.new && mv -T %s.new %s' % (releases_dir, release, current, current, current))
+        # pruned releases take their tarball along, unless a release we keep was unpacked from it too
+        b.sudo('ls -1dt %s/* | grep -vxF -e "$(readlink -f %s)" -e "$(readlink -f %s)" | tail -n +%d | '
+               'while read r; do c=$(cat $r/%s 2>/dev/null); rm -rf $r; '
+               '[ -z "$c" ] || cat %s/*/%s 2>/dev/null | grep -qxF $c || rm -f %s/$c; done' % (
+            releases_dir, current, previous, project['keep_releases'] - 1,
+            marker, releases_dir, marker, remote_dir), warn_only=True)
+    return reload_gunicorn()
+
+
+def rollback_release():
+    """Swap `current` and `previous` on the current host"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        target = sudo('readlink %s' % previous)
+    if target.failed or not target.strip():
+        abort("no previous release to roll back to")
+    return switch_release(os.path.basename(target.strip()))
+
+
+def record_release(checksum):
+    """Remember the tarballs we have deployed, dropping the ones too old to have a release left from the controller cache"""
+    deployed = [c for c in load_json(index_file, []) if c != checksum] + [checksum]
+    for old in deployed[:-project['keep_releases']]:
+        if os.path.exists(local_path(old)):
+            os.remove(local_path(old))
+    save_json(index_file, deployed[-project['keep_releases']:])
+
+
+def report(title, results):
+    failed = dict((h, r) for h, r in results.items() if isinstance(r, Failure))
+    if failed:
+        abort("%s failed on %s" % (title, ', '.join("%s (%s)" % (h, failed[h].reason) for h in sorted(failed))))
+
+
+def deploy_project(local_dir=None):
+    """Pack the project once, unpack it everywhere, then switch every box over and reload gunicorn"""
+    hosts = env.roledefs['production']
+    checksum = pack_tree(local_dir or project['local_dir'])
+    release = '%s-%s' % (datetime.now().strftime('%Y%m%d%H%M%S'), checksum[:12])
+    record_release(checksum)
+    spread_artifacts([checksum])
+    unpacked = fan_out(unpack_release, hosts, checksum, release)
+    report("unpacking %s" % release, unpacked)
+    if not any(unpacked.values()):
+        print "Release %s is already live everywhere" % checksum[:12]
+        return
+    # nothing goes live until every box holds the new release
+    switched = fan_out(switch_release, [h for h in hosts if unpacked[h]], release)
+    report("switching to %s" % release, switched)
+    for host in sorted(switched):
+        print "  %-20s now on %s%s" % (host, release, '' if switched[host] else ' (gunicorn not running)')
+
+
+def rollback_project():
+    """Put every box back on the release it ran before the last deploy"""
+    results = fan_out(rollback_release, env.roledefs['production'])
+    report("rollback", results)
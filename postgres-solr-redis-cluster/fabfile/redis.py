@@ -8,24 +8,620 @@ Support functions for managing a Redis server
 Created by: Rui Carmo
 """
 
-import os, sys, time
-from fabric.api import env, local, hosts, roles
+import os, sys, time, shutil
+from collections import OrderedDict
+from fabric.api import env, local, hosts, roles, cd
 from fabric.operations import run, sudo, put, hide, settings
-from fabric.contrib.files import contains, exists, cd, append, comment
+from fabric.contrib.files import contains, exists, append, comment
+from fabric.utils import abort
 from .helpers import psql, collect_ip_addresses
+from .batch import Batch, quote
+from .rollout import fan_out, run_step
+from .facts import get_facts
+from .tuning import redis_tuning, redis_bytes, version_tuple
+from .managed import render, sync_config, sync_configs, last_pushed
+from .handlers import notify, flush_handlers
+from .config import redis, state_dir
 
 prefix        = '/etc/redis/%s'
 redis_conf     = prefix % 'redis.conf'
+sentinel_conf  = prefix % 'sentinel.conf'
+sentinel_init  = '/etc/init.d/redis-sentinel'
+sysctl_conf    = '/etc/sysctl.d/30-redis.conf'
+thp_init       = '/etc/init.d/disable-thp'
+sentinel       = redis['sentinel']
+local_dir      = os.path.join(state_dir, 'redis-local')
+
+# settings redis can only pick up on restart - anything else is applied with CONFIG SET
+restart_settings = set([
+    'daemonize', 'pidfile', 'port', 'bind', 'logfile', 'databases', 'dbfilename',
+    'dir', 'requirepass', 'tcp-backlog', 'io-threads', 'io-threads-do-reads',
+    'slaveof', 'masterauth', 'cluster-enabled', 'cluster-config-file',
+])
+
+# Transparent hugepages make fork()ed snapshots copy 2MB pages and stall on compaction
+thp_script = """#!/bin/sh
+### BEGIN INIT INFO
+# Provides:          disable-thp
+# Required-Start:    $local_fs
+# Required-Stop:
+# X-Start-Before:    redis-server
+# Default-Start:     2 3 4 5
+# Default-Stop:
+# Short-Description: Disable transparent hugepages for redis
+### END INIT INFO
+
+case "$1" in
+  start)
+    for f in /sys/kernel/mm/transparent_hugepage/enabled /sys/kernel/mm/transparent_hugepage/defrag; do
+      [ -f $f ] && echo never > $f
+    done
+    ;;
+esac
+exit 0
+"""
+
+
+def tuning(role=None):
+    """Hardware-derived settings for the current host"""
+    return redis_tuning(get_facts(), role or redis['role'], redis['memory_share'], redis['version'])
+
+
+def redis_settings(password=None, role=None, primary=None, intf='eth0'):
+    """Full redis.conf settings (no bind line, so it listens on all interfaces).
+
+    Every box but the current primary replicates from it."""
+    password = password or redis['password']
+    conf = OrderedDict([
+        ('daemonize',                   'yes'),
+        ('pidfile',                     '/var/run/redis/redis-server.pid'),
+        ('port',                        redis['port']),
+        ('timeout',                     0),
+        ('loglevel',                    'notice'),
+        ('logfile',                     '/var/log/redis/redis-server.log'),
+        ('databases',                   16),
+        ('stop-writes-on-bgsave-error', 'yes'),
+        ('rdbcompression',              'yes'),
+        ('dbfilename',                  'dump.rdb'),
+        ('dir',                         '/var/lib/redis'),
+        ('requirepass',                 password),
+        # replicas authenticate with the same password, and so does a primary demoted by a failover
+        ('masterauth',                  password),
+        ('slave-read-only',             'yes'),
+        ('repl-backlog-size',           '64mb'),
+        ('slaveof',                     None),
+    ])
+    if cluster_mode():
+        # every box is a primary for its share of the hash slots
+        conf.update(cluster_settings(redis['port']))
+    elif primary and primary[0] != env.addresses[env.host][intf]:
+        conf['slaveof'] = '%s %d' % primary
+    conf.update(tuning(role))
+    return conf
+
+
+def cluster_mode():
+    return redis['mode'] == 'cluster'
+
+
+def cluster_settings(port):
+    return OrderedDict([
+        ('cluster-enabled',     'yes'),
+        ('cluster-config-file', 'nodes-%d.conf' % port),
+        ('cluster-node-timeout', redis['cluster']['node_timeout_ms']),
+    ])
+
+
+def sentinel_settings(primary, password=None):
+    """sentinel.conf as first written - Sentinel rewrites it with what it learns afterwards"""
+    name = sentinel['name']
+    return OrderedDict([
+        ('port',      sentinel['port']),
+        ('daemonize', 'yes'),
+        ('pidfile',   '/var/run/redis/redis-sentinel.pid'),
+        ('logfile',   '/var/log/redis/redis-sentinel.log'),
+        ('dir',       '/var/lib/redis'),
+        ('sentinel',  [
+            'monitor %s %s %d %d' % (name, primary[0], primary[1], sentinel['quorum']),
+            'auth-pass %s %s' % (name, password or redis['password']),
+            'down-after-milliseconds %s %d' % (name, sentinel['down_after_ms']),
+            'failover-timeout %s %d' % (name, sentinel['failover_timeout_ms']),
+            'parallel-syncs %s 1' % name,
+        ]),
+    ])
+
+
+def kernel_settings():
+    """Sysctls redis wants: overcommit so background saves can fork, and a listen queue to match tcp-backlog"""
+    return render(OrderedDict([
+        ('vm.overcommit_memory', 1),
+        ('net.core.somaxconn',   1024),
+    ]), 'postgres')
+
+
+def conf_values(content):
+    """Read back a rendered redis.conf as key -> list of values (save lines repeat)"""
+    values = {}
+    for line in (content or '').splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            key, _, value = line.partition(' ')
+            values.setdefault(key, []).append(value)
+    return values
+
+
+def redis_cli(command, password=None):
+    return 'redis-cli --raw -p %d -a %s %s' % (redis['port'], quote(password or redis['password']), command)
+
+
+def sentinel_cli(command):
+    return 'redis-cli --raw -p %d %s' % (sentinel['port'], command)
+
+
+def cli_lines(out):
+    """Output lines from redis-cli, minus the warning newer versions print when given -a"""
+    return [l.rstrip('\r') for l in out.split('\n') if not l.startswith('Warning: Using a password')]
+
+
+def configure_kernel():
+    """Apply redis' sysctls and disable transparent hugepages, now and on boot"""
+    changed = sync_configs([
+        (sysctl_conf, kernel_settings(), 'root:root', '0644'),
+        (thp_init,    thp_script,        'root:root', '0755'),
+    ])
+    with Batch() as b:
+        if sysctl_conf in changed:
+            b.sudo('sysctl -p %s' % sysctl_conf)
+        if thp_init in changed:
+            b.sudo('update-rc.d disable-thp defaults && %s start' % thp_init)
+    return changed
+
+
+def current_primary(intf='eth0'):
+    """Where the primary is now: the local Sentinel's answer if it has one (it may have failed over), else the master box"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo(sentinel_cli('SENTINEL get-master-addr-by-name %s' % sentinel['name']))
+    lines = cli_lines(out)
+    if out.succeeded and len(lines) >= 2 and lines[1].isdigit():
+        return lines[0], int(lines[1])
+    master = env.roledefs['master'][0]
+    if master not in env.addresses:
+        raise KeyError("could not find master IP address")
+    return env.addresses[master][intf], redis['port']
+
+
+def configure_redis(password=None, role=None, intf='eth0'):
+    """Push the rendered redis.conf, then apply what changed live or ask for a restart"""
+    collect_ip_addresses(intf)
+    conf = redis_settings(password, role, None if cluster_mode() else current_primary(intf), intf)
+    content = render(conf, 'redis')
+    old, new = conf_values(last_pushed(redis_conf)), conf_values(content)
+    keys = set(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+    if not sync_config(redis_conf, content, 'redis:redis', '0640'):
+        return False
+    if not old or keys & restart_settings or set(old) - set(new):
+        notify('redis-server')
+        return True
+    # everything else can be changed on the running server
+    with Batch() as b:
+        for key in sorted(keys):
+            b.sudo(redis_cli('CONFIG SET %s %s' % (key, quote(' '.join(new[key]).strip('"'))), password))
+    print "[%s] redis: applied %s live" % (env.host, ', '.join(sorted(keys)))
+    return True
+
 
 @roles('production')
 def rebind_redis():
     """Bind redis to all interfaces"""
-    comment(redis_conf,"^bind", use_sudo=True)
-    sudo('service redis-server restart')
+    configure_redis()
 
 
 @roles('production')
-def lockdown_redis(password='project'):
+def lockdown_redis(password=None):
     """Lockdown redis with a temporary password"""
-    append(redis_conf,"requirepass %s" % password, use_sudo = True)
-    sudo('service redis-server restart')
+    configure_redis(password)
+
+
+def configure_sentinel(password=None, intf='eth0'):
+    """Write sentinel.conf on first install, and keep the tunables in line on a running Sentinel"""
+    primary = current_primary(intf)
+    if sync_configs([(sentinel_init, sentinel_init_script, 'root:root', '0755')]):
+        notify('redis-sentinel')
+    name = sentinel['name']
+    with Batch() as b:
+        # Sentinel owns this file once it runs (it records replicas and failovers in it)
+        b.put(render(sentinel_settings(primary, password), 'redis'), sentinel_conf,
+              perms='0640', owner='redis:redis', only_if_missing=True)
+        b.sudo('update-rc.d redis-sentinel defaults')
+        b.sudo(sentinel_cli('SENTINEL SET %s down-after-milliseconds %d failover-timeout %d auth-pass %s' % (
+            name, sentinel['down_after_ms'], sentinel['failover_timeout_ms'], quote(password or redis['password']))),
+            warn_only=True)
+
+
+@roles('production')
+def setup_sentinel():
+    """Run a Sentinel on every box, watching the primary"""
+    if cluster_mode():
+        print "[%s] redis runs sharded, so there is no primary for Sentinel to watch" % env.host
+        return
+    configure_sentinel()
+
+
+@roles('production')
+def replication_status():
+    """INFO replication from the current host, and who its Sentinel thinks the primary is"""
+    with hide('running', 'output'):
+        b = Batch()
+        b.sudo(redis_cli('INFO replication'), warn_only=True)
+        b.sudo(sentinel_cli('SENTINEL get-master-addr-by-name %s' % sentinel['name']), warn_only=True)
+        info, primary = b.execute()
+    return parse_status(cli_lines(info), cli_lines(primary))
+
+
+def parse_status(info, primary):
+    status = dict(l.split(':', 1) for l in info if ':' in l and not l.startswith('#'))
+    status['sentinel_primary'] = ':'.join(primary[:2]) if len(primary) >= 2 and primary[1].isdigit() else None
+    return status
+
+
+def print_topology(statuses, addresses):
+    """Report each server's role, replication offset and how far behind the primary it is"""
+    primaries = [h for h, s in statuses.items() if isinstance(s, dict) and s.get('role') == 'master']
+    offset = int(statuses[primaries[0]].get('master_repl_offset', 0)) if len(primaries) == 1 else None
+    views = set(s['sentinel_primary'] for s in statuses.values() if isinstance(s, dict) and s.get('sentinel_primary'))
+    print "\nRedis topology (%s)" % (
+        'sentinels agree on %s' % views.pop() if len(views) == 1 else
+        'sentinels disagree: %s' % ', '.join(sorted(views)) if views else 'no sentinel answered')
+    for host in sorted(statuses):
+        s = statuses[host]
+        if not isinstance(s, dict) or 'role' not in s:
+            print "  %-20s %-14s %s" % (host, addresses.get(host, ''), s if not isinstance(s, dict) else 'not answering')
+        elif s['role'] == 'master':
+            print "  %-20s %-14s primary  offset %12s  %s replicas" % (
+                host, addresses.get(host, ''), s.get('master_repl_offset', '?'), s.get('connected_slaves', '?'))
+        else:
+            replica_offset = int(s.get('slave_repl_offset', 0))
+            print "  %-20s %-14s replica  offset %12d  lag %s bytes, link %s, last io %ss ago" % (
+                host, addresses.get(host, ''), replica_offset,
+                offset - replica_offset if offset is not None else '?',
+                s.get('master_link_status', '?'), s.get('master_last_io_seconds_ago', '?'))
+    if len(primaries) != 1:
+        print "  !! %d primaries found" % len(primaries)
+
+
+def redis_topology(intf='eth0'):
+    """Show which box is the redis primary and how far each replica lags behind it"""
+    run_step(collect_ip_addresses, 'production')
+    statuses = fan_out(replication_status, 'production')
+    print_topology(statuses, dict((h, env.addresses.get(h, {}).get(intf, '')) for h in statuses))
+    return statuses
+
+
+def local_redis(action='status', replicas=2):
+    """Run a throwaway primary, replicas and sentinels on localhost ports (start, stop, status or failover)"""
+    replicas, base = int(replicas), redis['local_port']
+    servers = [base + i for i in range(replicas + 1)]
+    sentinels = [base + 100 + i for i in range(len(servers))]
+    cli = lambda port, command: local('redis-cli --raw -p %d %s' % (port, command), capture=True)
+    if action == 'start':
+        for port in servers + sentinels:
+            path = os.path.join(local_dir, str(port))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            if port in servers:
+                conf = OrderedDict([('port', port), ('dir', path), ('daemonize', 'yes'),
+                                    ('pidfile', path + '/redis.pid'), ('logfile', path + '/redis.log'),
+                                    ('slaveof', None if port == base else '127.0.0.1 %d' % base)])
+                # a 1GB box's worth of memory per instance is plenty for testing
+                conf.update(redis_tuning({'memory_mb': 1024, 'cpus': 1}, redis['role'], redis['memory_share'], redis['version']))
+                options = ''
+            else:
+                conf = sentinel_settings(('127.0.0.1', base))
+                conf.update([('port', port), ('dir', path), ('pidfile', path + '/sentinel.pid'), ('logfile', path + '/sentinel.log')])
+                conf['sentinel'] = [l for l in conf['sentinel'] if not l.startswith('auth-pass')]
+                options = ' --sentinel'
+            with open(os.path.join(path, 'redis.conf'), 'w') as f:
+                f.write(render(conf, 'redis'))
+            local('redis-server %s%s' % (os.path.join(path, 'redis.conf'), options))
+    elif action == 'stop':
+        with settings(warn_only=True):
+            for port in sentinels + servers:
+                local('redis-cli -p %d shutdown nosave' % port)
+        return
+    elif action == 'failover':
+        print cli(sentinels[0], 'SENTINEL failover %s' % sentinel['name'])
+    elif action != 'status':
+        abort("unknown action %r (expected start, stop, status or failover)" % action)
+    time.sleep(1)
+    statuses = {}
+    with settings(warn_only=True):
+        for i, port in enumerate(servers):
+            statuses['localhost:%d' % port] = parse_status(
+                cli_lines(cli(port, 'INFO replication')),
+                cli_lines(cli(sentinels[i], 'SENTINEL get-master-addr-by-name %s' % sentinel['name'])))
+    print_topology(statuses, {})
+    return statuses
+
+
+# Sharded mode: redis-cli --cluster does the slot bookkeeping. Each helper takes a
+# runner that executes a list of commands somewhere (in one Batch on the master, or
+# locally for testing) so the same code drives both.
+
+def remote_runner(commands, warn_only=True):
+    with hide('running', 'output'):
+        b = Batch()
+        for command in commands:
+            b.sudo(command, warn_only=warn_only)
+        return b.execute()
+
+
+def local_runner(commands, warn_only=True):
+    results = []
+    for command in commands:
+        with settings(hide('running', 'warnings'), warn_only=warn_only):
+            results.append(local(command, capture=True))
+    return results
+
+
+def node_cli(address, command, password=None):
+    host, port = address.rsplit(':', 1)
+    auth = ' -a %s' % quote(password) if password else ''
+    return 'redis-cli --raw -h %s -p %s%s %s' % (host, port, auth, command)
+
+
+def cluster_cli(args, password=None):
+    auth = '-a %s ' % quote(password) if password else ''
+    return 'redis-cli %s--cluster %s' % (auth, args)
+
+
+def require_cluster_support():
+    if version_tuple(redis['version']) < (5,):
+        abort("sharded mode needs redis 5.0 or later (redis-cli --cluster), config.redis['version'] is %s" % redis['version'])
+
+
+def parse_cluster_nodes(lines):
+    """CLUSTER NODES output as a list of dicts, with the number of slots each primary owns"""
+    nodes = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        slots = 0
+        for spec in fields[8:]:
+            if spec.startswith('['):
+                continue  # a slot being migrated, still counted on its owner
+            first, _, last = spec.partition('-')
+            slots += int(last or first) - int(first) + 1
+        nodes.append({
+            'id'     : fields[0],
+            'address': fields[1].split('@')[0],
+            'flags'  : fields[2].split(','),
+            'master' : fields[3] if fields[3] != '-' else None,
+            'link'   : fields[7],
+            'slots'  : slots,
+        })
+    return nodes
+
+
+def cluster_state(runner, entry, password=None):
+    info, nodes = runner([node_cli(entry, 'CLUSTER INFO', password), node_cli(entry, 'CLUSTER NODES', password)])
+    info = dict(l.split(':', 1) for l in cli_lines(info) if ':' in l)
+    return info, parse_cluster_nodes(cli_lines(nodes))
+
+
+def create_cluster(runner, addresses, password=None):
+    """Join the nodes into a cluster and spread the slots evenly, unless they already form one"""
+    info, nodes = cluster_state(runner, addresses[0], password)
+    if int(info.get('cluster_known_nodes', 1)) > 1 or int(info.get('cluster_slots_assigned', 0)) > 0:
+        print "redis cluster already has %s nodes and %s slots assigned" % (
+            info.get('cluster_known_nodes'), info.get('cluster_slots_assigned'))
+        return False
+    runner([cluster_cli('create %s --cluster-replicas %d --cluster-yes' % (
+        ' '.join(addresses), redis['cluster']['replicas']), password)], warn_only=False)
+    return True
+
+
+def grow_cluster(runner, addresses, password=None):
+    """Add nodes that aren't in the cluster yet, then move slots onto them"""
+    info, nodes = cluster_state(runner, addresses[0], password)
+    known = set(n['address'] for n in nodes)
+    entry = [n['address'] for n in nodes if 'master' in n['flags'] and n['slots']][0]
+    new = [a for a in addresses if a not in known]
+    if not new:
+        print "every node is already in the redis cluster"
+        return []
+    runner([cluster_cli('add-node %s %s' % (address, entry), password) for address in new] +
+           [cluster_cli('rebalance %s --cluster-use-empty-masters' % entry, password)], warn_only=False)
+    return new
+
+
+def print_slots(runner, entry, password=None):
+    """Report how the hash slots, keys and memory are spread over the cluster's nodes"""
+    info, nodes = cluster_state(runner, entry, password)
+    commands = []
+    for node in nodes:
+        commands += [node_cli(node['address'], 'INFO memory', password), node_cli(node['address'], 'DBSIZE', password)]
+    outputs = runner(commands)
+    print "\nRedis cluster: state %s, %s/16384 slots assigned, %s nodes" % (
+        info.get('cluster_state', '?'), info.get('cluster_slots_assigned', '?'), info.get('cluster_known_nodes', '?'))
+    for i, node in enumerate(nodes):
+        node['memory'] = dict(l.split(':', 1) for l in cli_lines(outputs[2 * i]) if ':' in l).get('used_memory_human', '?')
+        node['keys'] = (cli_lines(outputs[2 * i + 1]) or ['?'])[0]
+    for node in sorted(nodes, key=lambda n: n['address']):
+        print "  %-22s %-8s %5d slots (%5.1f%%)  %10s keys  %8s used  link %s" % (
+            node['address'], 'primary' if 'master' in node['flags'] else 'replica', node['slots'],
+            100.0 * node['slots'] / 16384, node['keys'], node['memory'], node['link'])
+    return nodes
+
+
+def cluster_addresses(intf='eth0'):
+    return ['%s:%d' % (env.addresses[h][intf], redis['port']) for h in env.roledefs['production']]
+
+
+@roles('master')
+def create_redis_cluster(intf='eth0'):
+    """Shard redis across every production box (sharded mode only)"""
+    if not cluster_mode():
+        print "config.redis['mode'] is %s, not creating a cluster" % redis['mode']
+        return
+    require_cluster_support()
+    run_step(collect_ip_addresses, 'production')
+    create_cluster(remote_runner, cluster_addresses(intf), redis['password'])
+    return print_slots(remote_runner, cluster_addresses(intf)[0], redis['password'])
+
+
+@roles('master')
+def rebalance_redis_cluster(intf='eth0'):
+    """Bring boxes newly added to the production role into the cluster and even out the slots"""
+    require_cluster_support()
+    run_step(collect_ip_addresses, 'production')
+    grow_cluster(remote_runner, cluster_addresses(intf), redis['password'])
+    return print_slots(remote_runner, cluster_addresses(intf)[0], redis['password'])
+
+
+@roles('master')
+def redis_slots(intf='eth0'):
+    """Show the slot, key and memory distribution of the redis cluster"""
+    run_step(collect_ip_addresses, 'production')
+    return print_slots(remote_runner, '%s:%d' % (env.addresses[env.host][intf], redis['port']), redis['password'])
+
+
+def local_redis_cluster(action='status', nodes=3):
+    """Run a sharded cluster on localhost ports (start, add, status or stop) for testing"""
+    require_cluster_support()
+    base, root = redis['local_port'] + 200, os.path.join(local_dir, 'cluster')
+    running = sorted(int(p) for p in os.listdir(root)) if os.path.exists(root) else []
+    addresses = lambda ports: ['127.0.0.1:%d' % p for p in ports]
+
+    def start(port):
+        path = os.path.join(root, str(port))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        conf = OrderedDict([('port', port), ('dir', path), ('daemonize', 'yes'),
+                            ('pidfile', path + '/redis.pid'), ('logfile', path + '/redis.log')])
+        conf.update(cluster_settings(port))
+        conf.update(redis_tuning({'memory_mb': 1024, 'cpus': 1}, redis['role'], redis['memory_share'], redis['version']))
+        with open(os.path.join(path, 'redis.conf'), 'w') as f:
+            f.write(render(conf, 'redis'))
+        local('redis-server %s' % os.path.join(path, 'redis.conf'))
+
+    if action == 'start':
+        ports = [base + i for i in range(int(nodes))]
+        for port in ports:
+            start(port)
+        time.sleep(1)
+        create_cluster(local_runner, addresses(ports))
+    elif action == 'add':
+        port = (running[-1] if running else base - 1) + 1
+        start(port)
+        time.sleep(1)
+        grow_cluster(local_runner, addresses(running + [port]))
+    elif action == 'stop':
+        with settings(warn_only=True):
+            for port in running:
+                local('redis-cli -p %d shutdown nosave' % port)
+                shutil.rmtree(os.path.join(root, str(port)))
+        return
+    elif action != 'status':
+        abort("unknown action %r (expected start, add, status or stop)" % action)
+    return print_slots(local_runner, addresses(running or [base])[0])
+
+
+@roles('production')
+def tune_redis(role=None):
+    """Apply the memory/persistence profile for a role (broker, cache or store) and the kernel settings it needs"""
+    configure_kernel()
+    configure_redis(role=role)
+    flush_handlers('redis-server')
+    return verify_redis(role)
+
+
+@roles('production')
+def verify_redis(role=None):
+    """Check the running server's CONFIG GET/INFO and the kernel against what the profile asks for"""
+    with hide('running', 'output'):
+        b = Batch()
+        b.sudo(redis_cli("CONFIG GET '*'"), warn_only=True)
+        b.sudo(redis_cli('INFO'), warn_only=True)
+        b.sudo('sysctl -n vm.overcommit_memory net.core.somaxconn; '
+               'cat /sys/kernel/mm/transparent_hugepage/enabled 2>/dev/null || echo n/a', warn_only=True)
+        config, info, kernel = b.execute()
+    lines = cli_lines(config)
+    running = dict(zip(lines[0::2], lines[1::2]))
+    stats = dict(l.split(':', 1) for l in cli_lines(info) if ':' in l and not l.startswith('#'))
+    overcommit, somaxconn, thp = (kernel.splitlines() + ['?'] * 3)[:3]
+
+    mismatched = []
+    print "\n[%s] redis %s, %s profile" % (env.host, stats.get('redis_version', '?'), role or redis['role'])
+    for key, value in tuning(role).items():
+        wanted = ' '.join(value).strip('"') if isinstance(value, list) else str(value)
+        actual = running.get(key, '(unset)')
+        same = redis_bytes(actual) == redis_bytes(wanted) if key.endswith('size') or key == 'maxmemory' else actual == wanted
+        if not same:
+            mismatched.append(key)
+        print "  %s %-28s %16s -> %s" % (' ' if same else '*', key, actual, wanted)
+    checks = [
+        ('vm.overcommit_memory', overcommit, '1'),
+        ('net.core.somaxconn',   somaxconn, '1024'),
+        ('transparent_hugepage', thp, '[never]'),
+    ]
+    for key, actual, wanted in checks:
+        same = wanted in actual
+        if not same:
+            mismatched.append(key)
+        print "  %s %-28s %16s -> %s" % (' ' if same else '*', key, actual.strip(), wanted)
+    print "  used %s of %s, fragmentation %s, aof %s, last bgsave %s" % (
+        stats.get('used_memory_human', '?'), stats.get('maxmemory_human', running.get('maxmemory', '?')),
+        stats.get('mem_fragmentation_ratio', '?'), stats.get('aof_enabled', '?'), stats.get('rdb_last_bgsave_status', '?'))
+    return mismatched
+
+
+sentinel_init_script = """#! /bin/sh
+
+### BEGIN INIT INFO
+# Provides:             redis-sentinel
+# Required-Start:       $remote_fs $syslog $network redis-server
+# Required-Stop:        $remote_fs $syslog $network
+# Default-Start:        2 3 4 5
+# Default-Stop:         0 1 6
+# Short-Description:    Redis Sentinel
+### END INIT INFO
+
+DAEMON=/usr/bin/redis-server
+CONF=/etc/redis/sentinel.conf
+PID_FILE=/var/run/redis/redis-sentinel.pid
+
+test -x $DAEMON || exit 0
+test -f $CONF || exit 0
+
+. /lib/lsb/init-functions
+
+case $1 in
+    start)
+        mkdir -p /var/run/redis && chown redis:redis /var/run/redis
+        log_daemon_msg "Starting Redis Sentinel" "redis-sentinel"
+        if start-stop-daemon --start --quiet --pidfile $PID_FILE --chuid redis:redis --exec $DAEMON -- $CONF --sentinel; then
+            log_end_msg 0
+        else
+            log_end_msg 1
+        fi
+        ;;
+    stop)
+        log_daemon_msg "Stopping Redis Sentinel" "redis-sentinel"
+        start-stop-daemon --stop --quiet --pidfile $PID_FILE --retry 30
+        log_end_msg $?
+        ;;
+    restart)
+        $0 stop
+        sleep 1
+        $0 start
+        ;;
+    status)
+        status_of_proc -p $PID_FILE $DAEMON redis-sentinel && exit 0 || exit $?
+        ;;
+    *)
+        echo "Usage: $0 {start|stop|restart|status}" >&2
+        exit 1
+        ;;
+esac
+"""
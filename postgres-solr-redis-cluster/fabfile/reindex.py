@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Solr reindexing
+
+Rebuilds a Solr collection from Postgres on the master box. Rows are streamed
+through server-side cursors, split into primary-key ranges that a pool of worker
+processes turns into Solr documents and posts in large batches. Solr is only
+committed once every range is in, and each finished range is recorded so an
+interrupted run picks up where it left off.
+"""
+
+import json
+from base64 import b64encode
+from fabric.api import env, roles, hide, settings, abort
+from fabric.operations import sudo
+from .managed import sync_config
+from .config import postgres, solr, reindex
+
+script_path = '/usr/local/lib/fabric/reindex.py'
+
+
+def state_path(collection):
+    return '/var/lib/postgresql/reindex-%s.json' % collection
+
+
+@roles('master')
+def reindex_solr(collection=None, partitions=None, workers=None, fresh=False):
+    """Rebuild a Solr collection from Postgres (pass fresh=1 to ignore an interrupted run)"""
+    collection = collection or solr['collection']
+    options = {
+        'dsn'       : 'dbname=%s' % postgres['database'],
+        'query'     : reindex['query'],
+        'table'     : reindex['table'],
+        'key'       : reindex['key'],
+        'batch_size': reindex['batch_size'],
+        'partitions': int(partitions or reindex['partitions']),
+        'workers'   : int(workers or reindex['workers']),
+        'solr'      : 'http://localhost:%d/solr/%s/update' % (solr['port'], collection),
+        'state'     : state_path(collection),
+        'fresh'     : fresh in [True, 'True', 'true', '1', 'yes'],
+    }
+    with hide('running'):
+        sudo('mkdir -p /usr/local/lib/fabric')
+        sync_config(script_path, reindex_script, 'root:root', '0755')
+    # progress lines stream back as the workers report in
+    with settings(hide('running')):
+        out = sudo('python %s %s' % (script_path, b64encode(json.dumps(options))), user='postgres')
+    summary = [l for l in out.splitlines() if l.startswith('@@reindex ')]
+    if not summary:
+        abort("reindex finished without a summary")
+    return json.loads(summary[-1][len('@@reindex '):])
+
+
+reindex_script = r'''#!/usr/bin/env python
+# Managed by fabric - local changes will be overwritten
+import os, sys, json, time, base64, urllib2, datetime, decimal
+from multiprocessing import Pool, Queue, TimeoutError
+import psycopg2
+
+options = json.loads(base64.b64decode(sys.argv[1]))
+progress = None
+
+
+def load_state():
+    if options['fresh'] or not os.path.exists(options['state']):
+        return {'done': [], 'rows': 0}
+    with open(options['state']) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    with open(options['state'] + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(options['state'] + '.tmp', options['state'])
+
+
+def value(v):
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat() + ('Z' if isinstance(v, datetime.datetime) and not v.tzinfo else '')
+    if isinstance(v, decimal.Decimal):
+        return float(v)
+    return v
+
+
+def post(docs, commit=False):
+    request = urllib2.Request(options['solr'] + ('?commit=true' if commit else ''), json.dumps(docs),
+                              {'Content-Type': 'application/json'})
+    urllib2.urlopen(request, timeout=600).read()
+
+
+def key_ranges(conn):
+    """Split the key space into equal-width [start, end) ranges"""
+    if options['partitions'] <= 1:
+        return [[None, None]]
+    cursor = conn.cursor()
+    cursor.execute('SELECT min(%(key)s), max(%(key)s) FROM (%(query)s) AS src' % options)
+    low, high = cursor.fetchone()
+    if low is None:
+        return []
+    step = max((high - low + 1) / options['partitions'], 1)
+    bounds = range(low, high + 1, step) + [high + 1]
+    return [[bounds[i], bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def estimate(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", (options['table'],))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def init(queue):
+    global progress
+    progress = queue
+
+
+def index_range(bounds):
+    """Stream one key range through a named (server-side) cursor and post it in batches"""
+    start, end = bounds
+    conn = psycopg2.connect(options['dsn'])
+    conn.set_session(readonly=True)
+    cursor = conn.cursor('reindex_%s' % (start if start is not None else 'all'))
+    cursor.itersize = options['batch_size']
+    if start is None:
+        cursor.execute(options['query'])
+    else:
+        cursor.execute('SELECT * FROM (%(query)s) AS src WHERE %(key)s >= %%s AND %(key)s < %%s' % options, (start, end))
+    names, rows = None, 0
+    while True:
+        batch = cursor.fetchmany(options['batch_size'])
+        if not batch:
+            break
+        names = names or [c[0] for c in cursor.description]
+        post([dict((n, value(v)) for n, v in zip(names, row) if v is not None) for row in batch])
+        rows += len(batch)
+        progress.put(len(batch))
+    conn.close()
+    return bounds, rows
+
+
+def main():
+    state = load_state()
+    conn = psycopg2.connect(options['dsn'])
+    ranges = [r for r in key_ranges(conn) if r not in state['done']]
+    total = estimate(conn)
+    conn.close()
+    if state['done']:
+        print "resuming: %d ranges (%d rows) already posted, %d to go" % (len(state['done']), state['rows'], len(ranges))
+    queue = Queue()
+    pool = Pool(options['workers'], init, (queue,))
+    results = pool.imap_unordered(index_range, ranges)
+    started, prior, posted, finished, last = time.time(), state['rows'], 0, 0, 0
+    while finished < len(ranges):
+        try:
+            bounds, count = results.next(timeout=1)
+            state['done'].append(bounds)
+            state['rows'] += count
+            save_state(state)
+            finished += 1
+        except TimeoutError:
+            pass
+        except Exception as e:
+            pool.terminate()
+            print "reindex failed: %s (finished ranges are kept, run again to resume)" % e
+            sys.exit(1)
+        while not queue.empty():
+            posted += queue.get()
+        if time.time() - last >= 10 or finished == len(ranges):
+            last = time.time()
+            print "%d/%d ranges, %d rows%s, %.0f rows/s" % (
+                len(state['done']), len(state['done']) + len(ranges) - finished, prior + posted,
+                ' of ~%d' % total if total else '', posted / max(last - started, 0.001))
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
+    # nothing becomes visible until every range is in
+    post([], commit=True)
+    elapsed = time.time() - started
+    if os.path.exists(options['state']):
+        os.remove(options['state'])
+    print '@@reindex ' + json.dumps({'rows': state['rows'], 'ranges': len(state['done']), 'seconds': round(elapsed, 1),
+                                     'rows_per_sec': round((state['rows'] - prior) / max(elapsed, 0.001), 1)})
+
+
+if __name__ == '__main__':
+    main()
+'''
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rollout engine
+
+Runs a sequence of (task, hosts) steps across the cluster, fanning out the ones
+that only touch the box they run on and holding back those that depend on an
+earlier step having succeeded everywhere. Task/host pairs the deploy journal
+says have already converged are skipped.
+"""
+
+from fabric.api import env, execute, abort, settings
+from fabric.decorators import parallel
+from .config import concurrency
+from .handlers import flush_handlers
+from .facts import gather_facts
+from .journal import inputs_hash, remote_state, unchanged, record_tasks, record_state
+
+# steps that only touch the host they run on and can safely run on all hosts at once
+parallel_safe = set([
+    'gather_facts',
+    'collect_ip_addresses',
+    'setup_host',
+    'install_apt_bundle',
+    'install_wheelhouse',
+    'rebind_postgres',
+    'setup_database',
+    'setup_slaves',
+    'setup_pgbouncer',
+    'reload_pgbouncer',
+    'rebind_redis',
+    'lockdown_redis',
+    'tune_redis',
+    'verify_redis',
+    'setup_sentinel',
+    'replication_status',
+    'unpack_solr',
+    'setup_solr_service',
+    'ship_index',
+    'unpack_zookeeper',
+    'measure_latency',
+    'zookeeper_mntr',
+    'remote_state',
+    'flush_handlers',
+])
+
+# steps that must wait until another step has succeeded on every host
+depends_on = {
+    'setup_slaves'    : 'setup_master',
+    'setup_solr_slave': 'setup_solr_master',
+}
+
+# steps whose per-host return value is folded back into env (parallel runs happen
+# in forked processes, so anything they stash in env would otherwise be lost)
+env_merges = {
+    'gather_facts'        : 'facts',
+    'collect_ip_addresses': 'addresses',
+    'measure_latency'     : 'latency',
+}
+
+
+class StepFailed(Exception):
+    """Raised by abort() inside guarded steps, so the message can be reported"""
+
+
+class Failure(object):
+    """Marks a host on which a step failed, keeping the reason around for the summary"""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __repr__(self):
+        return "Failure(%r)" % self.reason
+
+
+def resolve_hosts(hosts):
+    """Accept either a role name or a list of hosts"""
+    if hosts is None:
+        return []
+    if isinstance(hosts, basestring):
+        return env.roledefs[hosts]
+    return list(hosts)
+
+
+def pool_size():
+    """Concurrency cap - `fab -z N` takes precedence over the configured default"""
+    return env.pool_size or concurrency['pool_size']
+
+
+def guarded(task):
+    """Wrap a task so that failures are returned as values instead of aborting the whole run"""
+    def inner(*args, **kwargs):
+        try:
+            with settings(abort_exception=StepFailed):
+                return task(*args, **kwargs)
+        except StepFailed as e:
+            return Failure(str(e))
+        except Exception as e:
+            return Failure("%s: %s" % (e.__class__.__name__, e))
+    inner.__name__ = task.__name__
+    return inner
+
+
+def fan_out(task, hosts, *args, **kwargs):
+    """Run a task on several hosts at once, returning a {host: result} dict"""
+    wrapped = parallel(pool_size=pool_size())(guarded(task))
+    return execute(wrapped, hosts=resolve_hosts(hosts), *args, **kwargs)
+
+
+def serially(task, hosts, *args, **kwargs):
+    """Run a task one host at a time, returning a {host: result} dict"""
+    return execute(guarded(task), hosts=resolve_hosts(hosts), *args, **kwargs)
+
+
+def run_step(task, hosts, *args, **kwargs):
+    """Run a single step, picking the execution mode from the task name (no hosts means once, locally)"""
+    if hosts is None:
+        results = {'<local>': guarded(task)(*args, **kwargs)}
+    elif task.__name__ in parallel_safe:
+        results = fan_out(task, hosts, *args, **kwargs)
+    else:
+        results = serially(task, hosts, *args, **kwargs)
+    key = env_merges.get(task.__name__)
+    if key:
+        for host, result in results.items():
+            if not isinstance(result, Failure):
+                env[key][host] = result
+    return results
+
+
+def unpack(step):
+    return step[0], step[1], step[2] if len(step) > 2 else {}
+
+
+def pending_hosts(task, hosts, kwargs, touched, states):
+    """Split a step's hosts into those it has to run on and those the journal lets it skip"""
+    run, skip = [], []
+    for host in hosts:
+        digest = inputs_hash(task, host, kwargs, touched)
+        (skip if unchanged(host, task.__name__, digest, states.get(host)) else run).append(host)
+    return run, skip
+
+
+def print_plan(steps, touched, states):
+    """List what each step will do on each host, as far as can be told before the first step runs"""
+    print "\nPlan (`--set force` runs everything, `--set plan` stops here)"
+    for step in steps:
+        task, hosts, kwargs = unpack(step)
+        if hosts is None:
+            print "  %-24s run locally" % task.__name__
+            continue
+        run, skip = pending_hosts(task, resolve_hosts(hosts), kwargs, touched, states)
+        print "  %-24s %s%s" % (task.__name__, 'run on %s' % ', '.join(run) if run else 'nothing to do',
+                                '; unchanged on %s' % ', '.join(skip) if skip else '')
+
+
+def rollout(steps):
+    """Run a list of (task, hosts[, kwargs]) steps in order, flush handlers and print a summary at the end.
+
+    Hosts that fail a step are left out of the following steps, and steps whose
+    dependency failed anywhere are skipped altogether. Failed hosts keep their
+    pending handlers for the next run. Steps whose inputs are worked out during
+    the rollout (like measured latency) are checked against the journal again
+    just before they run."""
+    force = env.get('force') in [True, 'True', 'true', '1', 'yes']
+    report = []
+    failed_hosts = set()
+    failed_steps = set()
+    touched = []
+    for step in steps:
+        touched.extend(h for h in resolve_hosts(step[1]) if h not in touched)
+    run_step(gather_facts, touched)
+    states = {}
+    if not force:
+        states = dict((h, s) for h, s in run_step(remote_state, touched).items() if not isinstance(s, Failure))
+    print_plan(steps, touched, states)
+    if env.get('plan') in [True, 'True', 'true', '1', 'yes']:
+        return report
+    for step in steps + [(flush_handlers, touched)]:
+        task, hosts, kwargs = unpack(step)
+        name = task.__name__
+        dependency = depends_on.get(name)
+        if dependency in failed_steps:
+            report.append((name, {}, "skipped, %s failed" % dependency, []))
+            failed_steps.add(name)
+            continue
+        skipped = []
+        if hosts is not None:
+            hosts = [h for h in resolve_hosts(hosts) if h not in failed_hosts]
+            hosts, skipped = pending_hosts(task, hosts, kwargs, touched, states)
+            if not hosts:
+                report.append((name, {}, "unchanged" if skipped else "skipped, no hosts left", skipped))
+                continue
+        results = run_step(task, hosts, **kwargs)
+        for host, result in results.items():
+            if isinstance(result, Failure):
+                if hosts is not None:
+                    failed_hosts.add(host)
+                failed_steps.add(name)
+            elif hosts is not None:
+                digest = inputs_hash(task, host, kwargs, touched)
+                if digest:
+                    record_tasks(host, {name: digest})
+        report.append((name, results, None, skipped))
+    # fingerprint the hosts as this run left them, so the next run can tell if they moved
+    for host, state in run_step(remote_state, touched).items():
+        if not isinstance(state, Failure):
+            record_state(host, state)
+    print_summary(report)
+    if failed_steps:
+        abort("rollout failed: %s" % ', '.join(sorted(failed_steps)))
+    return report
+
+
+def print_summary(report):
+    """Print one line per step and one per failed host"""
+    print "\nRollout summary (pool size %d)" % pool_size()
+    for name, results, note, skipped in report:
+        if note:
+            print "  %-24s %s" % (name, note)
+            continue
+        failures = dict((h, r) for h, r in results.items() if isinstance(r, Failure))
+        print "  %-24s %d ok, %d failed%s" % (name, len(results) - len(failures), len(failures),
+                                             ', %d unchanged' % len(skipped) if skipped else '')
+        for host in sorted(failures):
+            print "      %-20s %s" % (host, failures[host].reason)
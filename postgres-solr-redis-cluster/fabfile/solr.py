@@ -8,19 +8,38 @@ Support functions for setting up a Solr Cloud environment (tested on Solr 4.0)
 Created by: Rui Carmo
 """
 
-import os, sys
+import os, sys, json, tempfile
+from datetime import datetime
+from hashlib import sha1
+from base64 import b64encode
+from urllib import urlencode
+from collections import OrderedDict
 from StringIO import StringIO
-from fabric.api import env, local, hosts, roles
+from fabric.api import env, local, hosts, roles, cd, abort, execute
 from fabric.operations import run, sudo, put, hide, settings
 from fabric.context_managers import lcd
-from fabric.contrib.files import contains, exists, cd, append, comment, uncomment
+from fabric.contrib.files import contains, exists, append, comment, uncomment
 from fabric.contrib.project import rsync_project
 from .helpers import tarball, collect_ip_addresses
-from .config import tarballs
+from .batch import Batch, quote
+from .facts import get_facts
+from .tuning import solr_jvm, solr_plan, to_kb, redis_bytes
+from .postgres import tuning as postgres_tuning
+from .redis import tuning as redis_tuning
+from .zookeeper import heap_mb as zookeeper_heap_mb
+from .managed import render, sync_configs, changed_settings
+from .handlers import notify
+from .rollout import run_step, fan_out
+from .config import state_dir, load_json, save_json, tarballs, solr
 
 init_file     = '/etc/init.d/solr'
 defaults_file = '/etc/default/solr'
 data_dir      = '/srv/data/solr'
+releases_dir  = data_dir + '/releases'
+keep_releases = 2
+solr_data     = 'deploy/production/solr_data'
+manifest_name = '.manifest.json'
+manifest_cache = os.path.join(state_dir, 'solr-manifest-cache.json')
 
 
 
@@ -31,71 +50,368 @@ def unpack_solr():
         sudo('ln -s /srv/solr-4.4.0 /srv/solr')
 
 
-# Deploy a Solr init script
-def setup_solr_service():
-    if not exists(init_file):
-        put(StringIO(solr_init), init_file, use_sudo=True)
-        sudo('chmod +x ' + init_file)
-        sudo('chown root:root ' + init_file)
+def claimed_mb():
+    """Memory Postgres, Redis and ZooKeeper are set up to hold on the current host"""
+    return (to_kb(postgres_tuning()['shared_buffers']) / 1024 +
+            redis_bytes(redis_tuning()['maxmemory']) / (1024 * 1024) +
+            zookeeper_heap_mb())
+
+
+def jvm_options():
+    """Solr's JVM options for the current host, grouped as they go into the defaults file"""
+    options = solr_jvm(get_facts(), claimed_mb(), solr['heap_share'], solr['max_heap_mb'], solr['os_reserve_mb'])
+    options['gc_log'] = ['-verbose:gc', '-XX:+PrintGCDetails', '-XX:+PrintGCDateStamps',
+                         '-XX:+PrintGCApplicationStoppedTime', '-Xloggc:%s' % solr['gc_log'],
+                         '-XX:+UseGCLogFileRotation', '-XX:NumberOfGCLogFiles=5', '-XX:GCLogFileSize=20M']
+    return options
+
+
+def solr_defaults(intf='eth0'):
+    """Render /etc/default/solr - the master runs the embedded Zookeeper, slaves point at it"""
+    conf = OrderedDict([
+        ('SOLR_ENABLED',          'true'),
+        ('SOLR_LOCAL_ZOOKEEPER',  None),
+        ('SOLR_REMOTE_ZOOKEEPER', None),
+        # number of data shards (1 for mirroring, 2 for splitting, etc.)
+        ('SOLR_NUM_SHARDS',       1),
+        ('SOLR_USER',             'www-data'),
+        ('SOLR_COLLECTION',       'project'),
+        ('SOLR_DATA_DIR',         data_dir + '/project'),
+        ('SOLR_BOOTSTRAP',        ''),
+    ])
+    jvm = jvm_options()
+    conf['SOLR_HEAP']          = '"%s"' % ' '.join(jvm['heap'])
+    conf['SOLR_GC_OPTS']       = '"%s"' % ' '.join(jvm['gc'])
+    conf['SOLR_GC_LOG_OPTS']   = '"%s"' % ' '.join(jvm['gc_log'])
+    conf['SOLR_DIRECT_MEMORY'] = '"%s"' % ' '.join(jvm['direct_memory'])
+    if env.host in env.roledefs['slaves']:
+        host = env.roledefs['master'][0]
+        if host not in env.addresses:
+            raise KeyError("could not find master IP address")
+        conf['SOLR_REMOTE_ZOOKEEPER'] = '%s:9983' % env.addresses[host][intf]
+    else:
+        conf['SOLR_LOCAL_ZOOKEEPER'] = 'true'
+    return render(conf)
+
+
+def configure_solr():
+    """Push the init script and defaults, asking for a restart if either changed"""
+    defaults = solr_defaults()
+    jvm = sorted(k for k in changed_settings(defaults_file, defaults) if k.startswith(('SOLR_HEAP', 'SOLR_GC', 'SOLR_DIRECT')))
+    if sync_configs([
+        (init_file,     solr_init,  'root:root', '0755'),
+        (defaults_file, defaults,   'root:root', '0644'),
+    ]):
+        if jvm:
+            print "[%s] solr: JVM options changed (%s)" % (env.host, ', '.join(jvm))
+        notify('solr')
 
-    if not exists(defaults_file):
-        put(StringIO(solr_defaults), defaults_file, use_sudo=True)
 
-    if not exists(data_dir):
-        sudo('mkdir -p ' + data_dir)
-        sudo('chown -R www-data:www-data ' + data_dir)
-
-    # make sure all example paths are usable by www-data
-    sudo('update-rc.d solr defaults')
-    sudo('service solr restart')
+# Deploy a Solr init script
+def setup_solr_service():
+    # the init script has to be in place before update-rc.d can register it
+    configure_solr()
+    with Batch() as b:
+        for d in [data_dir, os.path.dirname(solr['gc_log'])]:
+            b.sudo('mkdir -p %s && chown -R www-data:www-data %s' % (d, d), unless='[ -e %s ]' % d)
+        b.sudo('update-rc.d solr defaults')
 
 
 def setup_solr_master():
-    uncomment(defaults_file, 'SOLR_LOCAL_ZOOKEEPER', use_sudo=True)
-    sudo('service solr restart')
+    configure_solr()
 
 
 def setup_solr_slave():
-    host = env.roledefs['master'][0]
-    if host not in env.addresses:
-        raise KeyError("could not find master IP address")
-    print host
-    master_ip = env.addresses[host]['eth0']
-    append(defaults_file, 'SOLR_REMOTE_ZOOKEEPER=%s:9983' % master_ip, use_sudo=True)
-    sudo('service solr restart')
-
-
-def upload_solr_collection():
-    # upload a pre-build Solr collection
-    with cd(data_dir):
-        sudo('chmod -R a+w .')
-    rsync_project(data_dir, local_dir = 'deploy/production/solr_data/')
-    with cd(data_dir):
-        sudo('chmod -R a-w .')
-        sudo('chown -R www-data:www-data project')
-
+    configure_solr()
+
+
+def build_manifest(root):
+    """SHA-1 and size of every file in a local index, re-hashing only files whose size or mtime changed"""
+    cache = load_json(manifest_cache, {})
+    manifest, used = {}, {}
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            full = os.path.join(path, name)
+            stat = os.stat(full)
+            key = '%s:%d:%d' % (os.path.abspath(full), stat.st_size, int(stat.st_mtime))
+            if key not in cache:
+                digest = sha1()
+                with open(full, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                        digest.update(chunk)
+                cache[key] = digest.hexdigest()
+            used[key] = cache[key]
+            manifest[os.path.relpath(full, root)] = [cache[key], stat.st_size]
+    save_json(manifest_cache, used)
+    return manifest
+
+
+def manifest_id(manifest):
+    return sha1(json.dumps(sorted(manifest.items()))).hexdigest()[:12]
+
+
+def remote_manifest(live):
+    """The manifest shipped with the live index, or checksums of whatever is there if it predates manifests"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo('cat %s/%s 2>/dev/null || (cd %s 2>/dev/null && find . -type f -exec sha1sum {} +)' % (
+            live, manifest_name, live))
+    out = out.strip()
+    if out.startswith('{'):
+        return dict((p, v[0]) for p, v in json.loads(out).items())
+    manifest = {}
+    for line in out.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) == 2 and fields[1].startswith('./'):
+            manifest[fields[1][2:]] = fields[0]
+    return manifest
+
+
+def ship_index(manifest, local_dir, collection):
+    """Bring the current host's index in line with the manifest and swap it in.
+
+    The new release starts as hardlinks to the live one, only segments the host is
+    missing go over the wire, and the live path is a symlink that is replaced with
+    a rename, so Solr never sees a partly copied directory."""
+    live = '%s/%s' % (data_dir, collection)
+    current = remote_manifest(live)
+    missing = sorted(p for p, (digest, size) in manifest.items() if current.get(p) != digest)
+    stale = sorted(p for p in current if p not in manifest and p != manifest_name)
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        linked = sudo('readlink %s' % live).strip()
+    if not missing and not stale and linked.endswith(manifest_id(manifest)):
+        return {'release': os.path.basename(linked), 'files': 0, 'bytes': 0, 'removed': 0}
+    # timestamped, so a re-ship never lands on (and deletes) the directory Solr is serving
+    release = '%s/%s-%s-%s' % (releases_dir, collection, datetime.now().strftime('%Y%m%d%H%M%S'), manifest_id(manifest))
+    as_solr = 'sudo -u www-data '
+
+    with Batch() as b:
+        b.sudo('mkdir -p %s && chown www-data:www-data %s' % (releases_dir, releases_dir))
+        b.sudo('rm -rf %s.tmp' % release)
+        if current:
+            b.sudo(as_solr + 'cp -al %s/. %s.tmp' % (live, release))
+        else:
+            b.sudo(as_solr + 'mkdir -p %s.tmp' % release)
+        if stale:
+            b.sudo('echo %s | base64 -d | (cd %s.tmp && xargs -d "\\n" rm -f --)' % (b64encode('\n'.join(stale)), release))
+    if missing:
+        handle, files_from = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as f:
+            f.write('\n'.join(missing) + '\n')
+        try:
+            # the remote end runs as the solr user, so nothing needs chown/chmod afterwards
+            rsync_project('%s.tmp/' % release, local_dir=local_dir.rstrip('/') + '/',
+                          extra_opts="--files-from=%s --rsync-path='sudo -u www-data rsync'" % files_from)
+        finally:
+            os.remove(files_from)
+    with Batch() as b:
+        b.put(json.dumps(manifest), '%s.tmp/%s' % (release, manifest_name), owner='www-data:www-data')
+        b.sudo('rm -rf %s && mv -T %s.tmp %s' % (release, release, release))
+        # a directory left by the old full-copy upload becomes the first release
+        b.sudo('[ -L %s ] || [ ! -d %s ] || mv -T %s %s/%s-legacy' % (live, live, live, releases_dir, collection))
+        b.sudo('ln -sfn %s %s.new && mv -T %s.new %s' % (release, live, live, live))
+        b.sudo('ls -1dt %s/%s-* | grep -vxF %s | tail -n +%d | xargs -r rm -rf' % (
+            releases_dir, collection, release, keep_releases), warn_only=True)
+    return {
+        'release': os.path.basename(release),
+        'files'  : len(missing),
+        'bytes'  : sum(manifest[p][1] for p in missing),
+        'removed': len(stale),
+    }
+
+
+def upload_solr_collection(local_dir=None, collection=None):
+    """Ship a pre-built collection to every box, sending each one only the segment files it lacks"""
+    collection = collection or solr['collection']
+    local_dir = local_dir or os.path.join(solr_data, collection)
+    manifest = build_manifest(local_dir)
+    print "Shipping %s: %d files, %d MB" % (collection, len(manifest), sum(v[1] for v in manifest.values()) / 1048576)
+    results = fan_out(ship_index, 'production', manifest, local_dir, collection)
+    print "\nSolr index shipping"
+    for host in sorted(results):
+        r = results[host]
+        if isinstance(r, dict):
+            print "  %-20s %-24s %5d files %8.1f MB sent, %d removed" % (
+                host, r['release'], r['files'], r['bytes'] / 1048576.0, r['removed'])
+        else:
+            print "  %-20s %s" % (host, r)
+    if any(not isinstance(r, dict) for r in results.values()):
+        abort("index shipping failed, not reloading %s" % collection)
+    # every box has swapped, so one collection-wide reload opens the new index everywhere
+    execute(reload_collection, collection, hosts=env.roledefs['master'])
+    return results
+
+
+def reload_collection(collection=None):
+    """Have every core of a collection reopen its index"""
+    return solr_api(remote_fetch, 'admin/collections', [('action', 'RELOAD'), ('name', collection or solr['collection'])])
+
+
+# SolrCloud layout. The Collections API calls go through curl on the master (or on
+# the controller for a local stand-in), using whichever `fetch` the caller passes.
+
+def remote_fetch(command):
+    with settings(hide('running', 'output')):
+        return run(command)
+
+
+def local_fetch(command):
+    with hide('running'):
+        return local(command, capture=True)
+
+
+def solr_api(fetch, path, params=(), base_url=None):
+    url = '%s/%s?%s' % (base_url or 'http://localhost:%d/solr' % solr['port'], path, urlencode(list(params) + [('wt', 'json')]))
+    out = fetch('curl -s --fail %s' % quote(url))
+    try:
+        return json.loads(out)
+    except ValueError:
+        abort("unexpected answer from %s: %s" % (url, out[:200]))
+
+
+def znode(fetch, path):
+    """Read a ZooKeeper node through Solr's admin servlet (Solr 4.4 has no CLUSTERSTATUS)"""
+    return solr_api(fetch, 'zookeeper', [('detail', 'true'), ('path', path)])
+
+
+def cluster_state(fetch):
+    data = znode(fetch, '/clusterstate.json').get('znode', {}).get('data')
+    return json.loads(data) if data else {}
+
+
+def live_nodes(fetch):
+    tree = znode(fetch, '/live_nodes').get('tree', [{}])
+    return sorted(c['data']['title'] for c in tree[0].get('children', []))
+
+
+def node_url(node):
+    """'10.0.0.1:8983_solr' -> 'http://10.0.0.1:8983/solr'"""
+    address, _, context = node.partition('_')
+    return 'http://%s/%s' % (address, context)
+
+
+def active_shards(state, collection):
+    shards = state.get(collection, {}).get('shards', {})
+    return OrderedDict(sorted((n, s) for n, s in shards.items() if s.get('state', 'active') == 'active'))
+
+
+def range_width(shard):
+    """How much of the hash ring a shard covers ('80000000-ffffffff'), as a stand-in for its size"""
+    low, _, high = shard.get('range', '').partition('-')
+    try:
+        return (int(high, 16) - int(low, 16)) % (1 << 32)
+    except ValueError:
+        return 0
+
+
+def measure_collection(fetch, state, collection):
+    """Document count and index size (one copy of each shard) of an existing collection"""
+    docs = solr_api(fetch, '%s/select' % collection, [('q', '*:*'), ('rows', 0)])['response']['numFound']
+    size = 0
+    for name, shard in active_shards(state, collection).items():
+        replicas = shard['replicas'].values()
+        leader = ([r for r in replicas if r.get('leader') == 'true'] or replicas)[0]
+        status = solr_api(fetch, 'admin/cores', [('action', 'STATUS'), ('core', leader['core'])], leader['base_url'])
+        size += status['status'][leader['core']]['index']['sizeInBytes']
+    return docs, size / (1024 * 1024)
+
+
+def apply_plan(fetch, plan, state, collection, nodes):
+    """Create the collection, or split shards and add replicas until it matches the plan"""
+    if collection not in state:
+        print "Creating %s: %d shards x %d replicas" % (collection, plan['shards'], plan['replicas'])
+        solr_api(fetch, 'admin/collections', [
+            ('action', 'CREATE'), ('name', collection), ('numShards', plan['shards']),
+            ('replicationFactor', plan['replicas']), ('maxShardsPerNode', plan['max_shards_per_node']),
+            ('collection.configName', collection), ('createNodeSet', ','.join(nodes))])
+        return cluster_state(fetch)
+
+    # each split turns one shard into two, so split only as many as are missing, widest ranges first
+    while len(active_shards(state, collection)) < plan['shards']:
+        shards = active_shards(state, collection)
+        before = len(shards)
+        widest = sorted(shards, key=lambda n: (-range_width(shards[n]), n))
+        for name in widest[:plan['shards'] - before]:
+            print "Splitting %s/%s" % (collection, name)
+            solr_api(fetch, 'admin/collections', [('action', 'SPLITSHARD'), ('collection', collection), ('shard', name)])
+            solr_api(fetch, 'admin/collections', [('action', 'DELETESHARD'), ('collection', collection), ('shard', name)])
+        state = cluster_state(fetch)
+        if len(active_shards(state, collection)) <= before:
+            abort("splitting %s left it with %d active shards" % (collection, len(active_shards(state, collection))))
+
+    # extra replicas go to whichever nodes hold the fewest cores
+    load = dict((n, 0) for n in nodes)
+    for shard in active_shards(state, collection).values():
+        for replica in shard['replicas'].values():
+            load[replica['node_name']] = load.get(replica['node_name'], 0) + 1
+    for name, shard in active_shards(state, collection).items():
+        holders = set(r['node_name'] for r in shard['replicas'].values())
+        for node in sorted((n for n in nodes if n not in holders), key=lambda n: load[n])[:max(plan['replicas'] - len(holders), 0)]:
+            core = '%s_%s_replica%d' % (collection, name, len(holders) + 1)
+            print "Adding %s on %s" % (core, node)
+            solr_api(fetch, 'admin/cores', [('action', 'CREATE'), ('name', core), ('collection', collection), ('shard', name)],
+                     node_url(node))
+            holders.add(node)
+            load[node] += 1
+    return cluster_state(fetch)
+
+
+def print_layout(state, collection, names=None):
+    """Show each shard's hash range and where its replicas live"""
+    shards = state.get(collection, {}).get('shards', {})
+    names = names or {}
+    print "\nCollection %s: %d active shards" % (collection, len(active_shards(state, collection)))
+    for name in sorted(shards):
+        shard = shards[name]
+        replicas = []
+        for replica in sorted(shard['replicas'].values(), key=lambda r: r['node_name']):
+            address = replica['node_name'].split(':')[0]
+            replicas.append('%s (%s%s)' % (names.get(address, replica['node_name']),
+                                           'leader, ' if replica.get('leader') == 'true' else '', replica['state']))
+        print "  %-12s %-9s %-18s %s" % (name, shard.get('state', 'active'), shard.get('range', ''), ', '.join(replicas))
+
+
+def print_plan(plan, docs, index_mb, nodes):
+    print "\nPlan for %d docs, %d MB over %d nodes: %d shards x %d replicas (max %d per node)" % (
+        docs, index_mb, len(nodes), plan['shards'], plan['replicas'], plan['max_shards_per_node'])
+    for shard, holders in plan['placement'].items():
+        print "  %-12s %s" % (shard, ', '.join(holders))
+    if plan['cache_bound']:
+        print "  !! the index is bigger than the page cache on these nodes - expect disk-bound queries"
+
+
+def plan_collection(fetch, collection, docs, index_mb, cache_mb, apply, names=None):
+    state = cluster_state(fetch)
+    nodes = live_nodes(fetch)
+    if not nodes:
+        abort("no live Solr nodes registered in ZooKeeper")
+    if docs is None or index_mb is None:
+        if collection not in state:
+            abort("%s doesn't exist yet - pass docs= and index_mb= to plan it" % collection)
+        measured = measure_collection(fetch, state, collection)
+        docs, index_mb = docs if docs is not None else measured[0], index_mb if index_mb is not None else measured[1]
+    plan = solr_plan(int(index_mb), int(docs), nodes, cache_mb, solr['shard_max_mb'], solr['shard_max_docs'])
+    print_plan(plan, int(docs), int(index_mb), nodes)
+    if apply in [True, 'True', 'true', '1', 'yes']:
+        state = apply_plan(fetch, plan, state, collection, nodes)
+    print_layout(state, collection, names)
+    return plan
+
+
+@roles('master')
+def plan_solr(collection=None, docs=None, index_mb=None, apply=False):
+    """Work out shard/replica counts from a collection's size and the live nodes, optionally creating or splitting it"""
+    run_step(collect_ip_addresses, 'production')
+    names = dict((a['eth0'], h) for h, a in env.addresses.items() if 'eth0' in a)
+    # what a box can keep in its page cache once Postgres, Redis and Solr's heap have their share
+    heap = int(jvm_options()['heap'][1][4:-1])
+    cache_mb = get_facts()['memory_mb'] - claimed_mb() - heap - solr['os_reserve_mb']
+    return plan_collection(remote_fetch, collection or solr['collection'], docs, index_mb, max(cache_mb, 0), apply, names)
+
+
+def local_solr_plan(collection=None, docs=None, index_mb=None, apply=False):
+    """Run the planner against a single Solr node on localhost"""
+    return plan_collection(local_fetch, collection or solr['collection'], docs, index_mb, float('inf'), apply)
 
-solr_defaults = """
-# comment this to prevent Solr from starting
-SOLR_ENABLED=true
-
-# uncomment this to run a local master/zookeper
-SOLR_LOCAL_ZOOKEEPER=true
-
-# uncomment this to run a local slave with a remote zookeper
-#SOLR_REMOTE_ZOOKEEPER=localhost:2181
-
-# number of data shards (1 for mirroring, 2 for splitting, etc.)
-SOLR_NUM_SHARDS=1
-
-SOLR_USER=www-data
-
-SOLR_COLLECTION=project
-
-SOLR_DATA_DIR=/srv/data/solr/project
-
-SOLR_BOOTSTRAP=
-"""
 
 solr_init = """#! /bin/sh
 
@@ -164,7 +480,7 @@ else
     SOLR_CLOUD_OPTIONS="-DzkHost=${SOLR_REMOTE_ZOOKEEPER} -Dbootstrap_confdir=${SOLR_DATA_DIR}/conf -Dcollection.configName=${SOLR_COLLECTION}"
 fi
 
-JAVA_OPTIONS="-Xmx256m -jar -Djetty.home=${SOLR_DATA_DIR} -Dsolr.solr.home=${SOLR_DIR} ${SOLR_DIR}/start.jar $SOLR_CLOUD_OPTIONS"
+JAVA_OPTIONS="${SOLR_HEAP} ${SOLR_GC_OPTS} ${SOLR_GC_LOG_OPTS} ${SOLR_DIRECT_MEMORY} -jar -Djetty.home=${SOLR_DATA_DIR} -Dsolr.solr.home=${SOLR_DIR} ${SOLR_DIR}/start.jar $SOLR_CLOUD_OPTIONS"
 
 . /lib/lsb/init-functions
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+psql sessions
+
+Queues SQL statements and streams them to a single psql process over stdin, so
+provisioning or a migration costs one round-trip and one backend per host no
+matter how many statements it has. psql is driven with markers between
+statements, so each one still comes back with its own rows, SQLSTATE and timing.
+"""
+
+import re, time, uuid
+from base64 import b64encode
+from StringIO import StringIO
+from fabric.api import env, hide, settings, abort, warn
+from fabric.operations import sudo, put
+from fabric.state import output
+from .batch import inline_limit
+from .trace import label
+
+# unit and substitute separators, which won't turn up in ordinary column values
+field_separator = '\x1f'
+null_marker     = '\x1a'
+
+# SQLSTATEs worth naming in calling code
+duplicate_object   = '42710'
+duplicate_database = '42P04'
+
+error_line   = re.compile(r'^(?:psql:[^:]*:\d+: )?(ERROR|FATAL|PANIC):\s+(?:([0-9A-Z]{5}): )?(.*)$')
+message_line = re.compile(r'^(?:psql:[^:]*:\d+: )?(WARNING|NOTICE|INFO|DEBUG|LOG|DETAIL|HINT|CONTEXT|LOCATION|QUERY):\s+(.*)$')
+timing_line  = re.compile(r'^Time: ([\d.]+) ms')
+
+
+def literal(value):
+    """Quote a value as an SQL string literal"""
+    if value is None:
+        return 'NULL'
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class QueryResult(object):
+    """Outcome of one statement in a session"""
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.rows = []
+        self.messages = []
+        self.error = None
+        self.code = None
+        self.ms = 0.0
+        self.ran = False
+
+    @property
+    def succeeded(self):
+        return self.ran and self.error is None
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def scalar(self):
+        """First column of the first row, or None"""
+        return self.rows[0][0] if self.rows and self.rows[0] else None
+
+    def __repr__(self):
+        return '<QueryResult %s %d rows %.1fms%s>' % (
+            self.sql.split('\n')[0][:40], len(self.rows), self.ms, (' %s' % self.code) if self.failed else '')
+
+
+class Session(object):
+    """A queue of SQL statements that runs through one psql invocation as the postgres user.
+
+    With transaction=True the statements run between BEGIN and COMMIT, and nothing
+    is committed if one of them fails."""
+
+    def __init__(self, database='postgres', transaction=False):
+        self.database = database
+        self.transaction = transaction
+        self.statements = []
+        self.results = []
+        self.committed = False
+        self.seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.execute()
+
+    def run(self, sql, ignore=None):
+        """Queue a statement. `ignore` lists SQLSTATEs that don't count as failures (or True for any)"""
+        sql = sql.strip()
+        if not sql.startswith('\\') and not sql.endswith(';'):
+            sql += ';'
+        self.statements.append((sql, ignore))
+        return self
+
+    def script(self, marker):
+        lines = [
+            '\\set ON_ERROR_STOP 1',
+            '\\set VERBOSITY verbose',
+            "\\pset fieldsep '\\037'",
+            "\\pset null '\\032'",
+            '\\timing on',
+        ]
+        if self.transaction:
+            lines.append('BEGIN;')
+        for i, (sql, ignore) in enumerate(self.statements):
+            lines.append('\\echo %s %d' % (marker, i))
+            if ignore:
+                # keep going, and inside a transaction roll back just this statement
+                lines += ['\\set ON_ERROR_STOP 0', '\\set ON_ERROR_ROLLBACK on', sql,
+                          '\\set ON_ERROR_ROLLBACK off', '\\set ON_ERROR_STOP 1']
+            else:
+                lines.append(sql)
+            lines.append('\\echo %s %d done' % (marker, i))
+        if self.transaction:
+            lines.append('COMMIT;')
+        lines.append('\\echo %s committed' % marker)
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, out, marker):
+        """Split psql's output back into one result per statement that ran"""
+        self.results = [QueryResult(sql) for sql, ignore in self.statements]
+        current = None
+        for line in out.replace('\r\n', '\n').split('\n'):
+            if line.startswith(marker + ' '):
+                fields = line.split()
+                if fields[1] == 'committed':
+                    self.committed = True
+                elif len(fields) == 2:
+                    current = self.results[int(fields[1])]
+                    current.ran = True
+                else:
+                    current = None
+                continue
+            if current is None:
+                continue
+            match = error_line.match(line)
+            if match:
+                current.error, current.code, current.message = match.group(1), match.group(2), match.group(3)
+                continue
+            match = message_line.match(line)
+            if match:
+                current.messages.append('%s: %s' % match.groups())
+                continue
+            match = timing_line.match(line)
+            if match:
+                current.ms += float(match.group(1))
+                continue
+            if line:
+                current.rows.append(tuple(None if v == null_marker else v for v in line.split(field_separator)))
+        return self.results
+
+    def command(self, script):
+        psql = 'psql -X -q -A -t -d %s 2>&1' % self.database
+        encoded = b64encode(script)
+        if len(encoded) < inline_limit:
+            return "echo %s | base64 -d | su - postgres -c '%s'" % (encoded, psql)
+        # too long for a single argument, so stream it from a file instead
+        path = '/tmp/fabric-%s.sql' % uuid.uuid4().hex[:12]
+        put(StringIO(script), path, use_sudo=True, mode=0644)
+        return "su - postgres -c '%s' < %s; rc=$?; rm -f %s; exit $rc" % (psql, path, path)
+
+    def execute(self):
+        """Run every queued statement in a single psql process"""
+        if not self.statements:
+            return []
+        marker = '@@sql-%s' % uuid.uuid4().hex[:12]
+        started = time.time()
+        with settings(hide('running', 'output', 'warnings'), warn_only=True), label('psql: %d statements' % len(self.statements)):
+            out = sudo(self.command(self.script(marker)))
+        self.seconds = time.time() - started
+        self.parse(out, marker)
+        for result in self.results:
+            if output.running and result.ran:
+                print "[%s] psql: %s (%.1f ms)" % (env.host_string, result.sql.split('\n')[0], result.ms)
+        failed = [r for r, (sql, ignore) in zip(self.results, self.statements)
+                  if r.ran and r.failed and not (ignore is True or (ignore and r.code in ignore))]
+        if failed:
+            message = "[%s] psql failed with %s %s: %s\n%s" % (
+                env.host_string, failed[0].error, failed[0].code, failed[0].sql, failed[0].message)
+            (warn if env.warn_only else abort)(message)
+        elif not self.committed:
+            (warn if env.warn_only else abort)("[%s] psql stopped after %d of %d statements:\n%s" % (
+                env.host_string, len([r for r in self.results if r.ran]), len(self.statements), out))
+        self.statements = []
+        return self.results
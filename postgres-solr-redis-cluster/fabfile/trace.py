@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Instrumentation
+
+Times every remote command, file transfer and task as it runs, with the bytes and
+round-trips each one costs. When a task given on the fab command line finishes,
+the events are written out as a Chrome trace (open it in chrome://tracing or
+ui.perfetto.dev, one row per host) and the slowest steps are printed.
+
+Parallel steps run in forked processes, so each process appends its events to a
+spool file of its own and the controller merges them at the end.
+"""
+
+import os, json, time, shutil
+from contextlib import contextmanager
+from datetime import datetime
+import fabric.main, fabric.operations, fabric.sftp, fabric.tasks
+from fabric.api import env
+from .config import state_dir, trace as options
+
+traces_dir = os.path.join(state_dir, 'traces')
+
+# the run being traced (set in the controller, inherited by forked workers)
+current = {'id': None, 'started': None}
+
+# names for the commands issued inside a `label()` block, innermost last
+labels = []
+
+
+def host():
+    return env.host_string or 'local'
+
+
+def spool_dir():
+    return os.path.join(traces_dir, current['id'])
+
+
+def record(name, category, started, **args):
+    """Append a finished event to this process' spool file"""
+    event = {'name': name, 'cat': category, 'host': host(), 'tid': os.getpid(),
+             'ts': int((started - current['started']) * 1e6), 'dur': int((time.time() - started) * 1e6), 'args': args}
+    with open(os.path.join(spool_dir(), '%d.jsonl' % os.getpid()), 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+@contextmanager
+def label(name):
+    """Name the commands issued inside the block (e.g. a batch) instead of showing their raw text"""
+    labels.append(name)
+    try:
+        yield
+    finally:
+        labels.pop()
+
+
+def describe(command):
+    if labels:
+        return labels[-1]
+    line = command.strip().split('\n')[0]
+    return line if len(line) <= 80 else line[:77] + '...'
+
+
+def local_size(local_path, local_is_path):
+    if local_is_path:
+        return os.path.getsize(local_path)
+    position = local_path.tell()
+    local_path.seek(0, 2)
+    length = local_path.tell()
+    local_path.seek(position)
+    return length
+
+
+def timed_command(original):
+    def inner(command, *args, **kwargs):
+        if not current['id']:
+            return original(command, *args, **kwargs)
+        started, out = time.time(), None
+        try:
+            out = original(command, *args, **kwargs)
+            return out
+        finally:
+            received = len(out) + len(out.stderr or '') if out is not None else 0
+            record(describe(command), 'sudo' if kwargs.get('sudo') else 'run', started, round_trips=1,
+                   sent=len(command), received=received, code=getattr(out, 'return_code', None))
+    return inner
+
+
+def timed_put(original):
+    def inner(self, local_path, remote_path, use_sudo, mirror_local_mode, mode, local_is_path, temp_dir):
+        if not current['id']:
+            return original(self, local_path, remote_path, use_sudo, mirror_local_mode, mode, local_is_path, temp_dir)
+        started = time.time()
+        try:
+            return original(self, local_path, remote_path, use_sudo, mirror_local_mode, mode, local_is_path, temp_dir)
+        finally:
+            record('put %s' % remote_path, 'put', started, round_trips=1,
+                   sent=local_size(local_path, local_is_path), received=0)
+    return inner
+
+
+def timed_get(original):
+    def inner(self, remote_path, local_path, use_sudo, local_is_path, *args, **kwargs):
+        if not current['id']:
+            return original(self, remote_path, local_path, use_sudo, local_is_path, *args, **kwargs)
+        started = time.time()
+        try:
+            return original(self, remote_path, local_path, use_sudo, local_is_path, *args, **kwargs)
+        finally:
+            received = local_size(local_path, local_is_path) if not local_is_path or os.path.exists(local_path) else 0
+            record('get %s' % remote_path, 'get', started, round_trips=1, sent=0, received=received)
+    return inner
+
+
+def timed_task(original):
+    def inner(self, *args, **kwargs):
+        if not current['id']:
+            return original(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            record(self.name, 'task', started)
+    return inner
+
+
+def traced_run(original):
+    """Wrap the execute() fab's main loop calls for each task named on the command line"""
+    def inner(task, *args, **kwargs):
+        begin(task)
+        try:
+            return original(task, *args, **kwargs)
+        finally:
+            finish()
+    return inner
+
+
+def begin(task):
+    current['id'] = '%s-%s' % (datetime.now().strftime('%Y%m%dT%H%M%S'), getattr(task, '__name__', task))
+    current['started'] = time.time()
+    if not os.path.exists(spool_dir()):
+        os.makedirs(spool_dir())
+
+
+def load_events():
+    events = []
+    for name in sorted(os.listdir(spool_dir())):
+        with open(os.path.join(spool_dir(), name)) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    return sorted(events, key=lambda e: e['ts'])
+
+
+def totals(events):
+    return {'round_trips': sum(e['args'].get('round_trips', 0) for e in events),
+            'sent'       : sum(e['args'].get('sent', 0) for e in events),
+            'received'   : sum(e['args'].get('received', 0) for e in events)}
+
+
+def attribute(events):
+    """Add up the commands each task span covers (tasks run locally cover every host)"""
+    commands = [e for e in events if e['cat'] != 'task']
+    for task in [e for e in events if e['cat'] == 'task']:
+        end = task['ts'] + task['dur']
+        task['args'].update(totals([c for c in commands if task['ts'] <= c['ts'] <= end
+                                    and task['host'] in ('local', c['host'])]))
+
+
+def chrome_trace(events):
+    """Trace Event Format: one process per host, one thread per worker process"""
+    hosts = sorted(set(e['host'] for e in events), key=lambda h: (h != 'local', h))
+    trace = [{'name': 'process_name', 'ph': 'M', 'pid': i, 'args': {'name': h}} for i, h in enumerate(hosts)]
+    for e in events:
+        trace.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'ts': e['ts'], 'dur': e['dur'],
+                      'pid': hosts.index(e['host']), 'tid': e['tid'], 'args': e['args']})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def size(count):
+    for unit in ['B', 'KB', 'MB']:
+        if count < 1024:
+            return '%d%s' % (count, unit)
+        count /= 1024.0
+    return '%.1fGB' % count
+
+
+def print_summary(events, path):
+    top = options['top']
+    commands = [e for e in events if e['cat'] != 'task']
+    tasks = [e for e in events if e['cat'] == 'task' and e['host'] != 'local']
+    print "\nTrace written to %s (%d events)" % (path, len(events))
+    if tasks:
+        print "Slowest tasks"
+        for e in sorted(tasks, key=lambda e: -e['dur'])[:top]:
+            print "  %8.2fs  %-14s %-26s %5d round-trips %9s sent %9s received" % (
+                e['dur'] / 1e6, e['host'], e['name'], e['args']['round_trips'], size(e['args']['sent']),
+                size(e['args']['received']))
+    if commands:
+        print "Slowest commands"
+        for e in sorted(commands, key=lambda e: -e['dur'])[:top]:
+            print "  %8.2fs  %-14s %-5s %s" % (e['dur'] / 1e6, e['host'], e['cat'], e['name'])
+        print "Per host"
+        for h in sorted(set(e['host'] for e in commands)):
+            mine = [e for e in commands if e['host'] == h]
+            t = totals(mine)
+            print "  %-14s %8.2fs in %d commands, %d round-trips, %s sent, %s received" % (
+                h, sum(e['dur'] for e in mine) / 1e6, len(mine), t['round_trips'], size(t['sent']), size(t['received']))
+
+
+def prune():
+    """Keep only the most recent traces"""
+    traces = sorted(f for f in os.listdir(traces_dir) if f.endswith('.json'))
+    for name in traces[:-options['keep']]:
+        os.remove(os.path.join(traces_dir, name))
+
+
+def finish():
+    try:
+        events = load_events()
+        attribute(events)
+        path = os.path.join(traces_dir, current['id'] + '.json')
+        with open(path, 'w') as f:
+            json.dump(chrome_trace(events), f)
+        print_summary(events, os.path.relpath(path))
+        prune()
+    finally:
+        shutil.rmtree(spool_dir(), ignore_errors=True)
+        current['id'] = None
+
+
+def instrument():
+    """Hook the timing wrappers into Fabric (once, and only when tracing is enabled)"""
+    if not options['enabled'] or getattr(fabric.operations._run_command, 'traced', False):
+        return
+    fabric.operations._run_command = timed_command(fabric.operations._run_command)
+    fabric.operations._run_command.traced = True
+    fabric.sftp.SFTP.put = timed_put(fabric.sftp.SFTP.put)
+    fabric.sftp.SFTP.get = timed_get(fabric.sftp.SFTP.get)
+    fabric.tasks.WrappedCallableTask.run = timed_task(fabric.tasks.WrappedCallableTask.run)
+    fabric.main.execute = traced_run(fabric.main.execute)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tuning profiles
+
+Works out service settings from host facts (RAM, CPUs, disk type) and a workload
+profile, so every box gets settings that fit its hardware instead of stock defaults.
+"""
+
+import math
+from collections import OrderedDict
+
+# per-workload knobs: how many work_mem allocations a connection may hold at once,
+# checkpoint spacing and how much effort the planner puts into statistics
+workloads = {
+    'oltp'     : {'work_mem_share': 4, 'checkpoint_segments': 32, 'statistics_target': 100},
+    'mixed'    : {'work_mem_share': 2, 'checkpoint_segments': 32, 'statistics_target': 100},
+    'reporting': {'work_mem_share': 1, 'checkpoint_segments': 64, 'statistics_target': 500},
+}
+
+
+def version_tuple(version):
+    return tuple(int(v) for v in str(version).split('.'))
+
+
+def has_ssd(facts):
+    """True if every physical disk on the box reports itself as non-rotational"""
+    disks = [d for name, d in facts.get('disks', {}).items() if not name.startswith(('loop', 'ram', 'sr'))]
+    return bool(disks) and not any(d['rotational'] for d in disks)
+
+
+def mb(value):
+    return '%dMB' % max(int(value), 1)
+
+
+def postgres_tuning(facts, workload='mixed', max_connections=100, version='9.2'):
+    """Memory, checkpoint, planner and parallelism settings for a box"""
+    if workload not in workloads:
+        raise ValueError("unknown workload %r (expected one of %s)" % (workload, ', '.join(sorted(workloads))))
+    profile = workloads[workload]
+    ram, cpus, ssd = facts['memory_mb'], max(facts['cpus'], 1), has_ssd(facts)
+    version = version_tuple(version)
+
+    # 9.2 gets little out of shared_buffers beyond 8GB - the OS cache does the rest
+    shared_buffers = min(ram / 4, 8192)
+    work_mem = (ram - shared_buffers) / (max_connections * profile['work_mem_share'])
+    settings = OrderedDict([
+        ('shared_buffers',               mb(shared_buffers)),
+        ('effective_cache_size',         mb(ram * 3 / 4)),
+        ('work_mem',                     mb(max(work_mem, 4))),
+        ('maintenance_work_mem',         mb(min(ram / 16, 2048))),
+        ('wal_buffers',                  '16MB'),
+        ('checkpoint_completion_target', '0.9'),
+        ('default_statistics_target',    profile['statistics_target']),
+        ('random_page_cost',             '1.1' if ssd else '4'),
+        ('effective_io_concurrency',     200 if ssd else 2),
+    ])
+    if version >= (9, 5):
+        settings['min_wal_size'] = mb(profile['checkpoint_segments'] * 16)
+        settings['max_wal_size'] = mb(profile['checkpoint_segments'] * 16 * 3)
+    else:
+        settings['checkpoint_segments'] = profile['checkpoint_segments']
+    # parallel query only exists from 9.6 onwards
+    if version >= (9, 6):
+        settings['max_worker_processes'] = cpus
+        settings['max_parallel_workers_per_gather'] = max(cpus / 2, 1) if workload == 'reporting' else max(cpus / 4, 1)
+    if version >= (10,):
+        settings['max_parallel_workers'] = cpus
+    return settings
+
+
+def to_kb(value, unit=None):
+    """Normalise a memory setting (either '64MB' or a pg_settings value/unit pair) to kB, for comparison"""
+    value = str(value).strip().strip("'")
+    factors = {'kB': 1, 'MB': 1024, 'GB': 1024 * 1024, '8kB': 8, '16MB': 16 * 1024}
+    if unit in factors:
+        return int(value) * factors[unit]
+    for suffix in ['kB', 'MB', 'GB']:
+        if value.endswith(suffix) and value[:-len(suffix)].isdigit():
+            return int(value[:-len(suffix)]) * factors[suffix]
+    return value
+
+
+def pgbouncer_pools(facts, per_core=2):
+    """Server connections per pool: a couple per core keeps every CPU busy without queueing in Postgres"""
+    cpus = max(facts['cpus'], 1)
+    return {
+        'default_pool_size': cpus * per_core + 1,
+        'reserve_pool_size': max(cpus / 2, 1),
+    }
+
+
+# per-role Redis knobs: what happens when memory runs out, how (and whether) data
+# is persisted, and how often the server does background work like expiring keys
+redis_roles = {
+    # celery queues must never be evicted, and should survive a restart
+    'broker': {'policy': 'noeviction',  'save': [], 'appendonly': 'yes', 'samples': 5, 'hz': 10},
+    # a pure cache: evict the least recently used keys, persist nothing
+    'cache':  {'policy': 'allkeys-lru', 'save': [], 'appendonly': 'no', 'samples': 10, 'hz': 20},
+    # primary data: snapshots plus an append-only log
+    'store':  {'policy': 'noeviction',  'save': ['900 1', '300 10', '60 10000'], 'appendonly': 'yes', 'samples': 5, 'hz': 10},
+}
+
+
+def redis_tuning(facts, role='broker', memory_share=0.25, version='2.8'):
+    """Memory, persistence and network settings for a Redis server on a box"""
+    if role not in redis_roles:
+        raise ValueError("unknown redis role %r (expected one of %s)" % (role, ', '.join(sorted(redis_roles))))
+    profile = redis_roles[role]
+    ram, cpus = facts['memory_mb'], max(facts['cpus'], 1)
+    version = version_tuple(version)
+
+    settings = OrderedDict([
+        ('maxmemory',                   '%dmb' % max(int(ram * memory_share), 64)),
+        ('maxmemory-policy',            profile['policy']),
+        ('maxmemory-samples',           profile['samples']),
+        # an empty save line turns RDB snapshots off
+        ('save',                        profile['save'] or ['""']),
+        ('appendonly',                  profile['appendonly']),
+        ('appendfsync',                 'everysec'),
+        ('no-appendfsync-on-rewrite',   'no' if role == 'store' else 'yes'),
+        ('auto-aof-rewrite-percentage', 100),
+        ('auto-aof-rewrite-min-size',   '64mb'),
+        ('hz',                          profile['hz']),
+    ])
+    if version >= (2, 8):
+        settings['tcp-backlog'] = 511
+        settings['tcp-keepalive'] = 60
+    # threaded I/O only exists from 6.0 onwards, and only pays off with cores to spare
+    if version >= (6,) and cpus >= 4:
+        settings['io-threads'] = min(cpus / 2, 8)
+        settings['io-threads-do-reads'] = 'yes'
+    return settings
+
+
+def redis_bytes(value):
+    """Normalise a Redis memory setting ('512mb', '1gb' or plain bytes) to bytes, for comparison"""
+    value = str(value).strip().lower()
+    factors = {'kb': 1024, 'mb': 1024 * 1024, 'gb': 1024 * 1024 * 1024, 'k': 1000, 'm': 1000 * 1000, 'g': 1000 * 1000 * 1000}
+    for suffix in ['kb', 'mb', 'gb', 'k', 'm', 'g']:
+        if value.endswith(suffix) and value[:-len(suffix)].isdigit():
+            return int(value[:-len(suffix)]) * factors[suffix]
+    return int(value) if value.isdigit() else value
+
+
+def solr_jvm(facts, claimed_mb=0, heap_share=0.5, max_heap_mb=31744, reserve_mb=1024):
+    """Heap, collector and direct memory for Solr, from whatever RAM the other services leave over.
+
+    Only part of what's left goes to the heap - Lucene reads the index through
+    mmap, so the page cache is what keeps searches fast."""
+    free = max(facts['memory_mb'] - claimed_mb - reserve_mb, 512)
+    # stay under 32GB so the JVM keeps using compressed object pointers
+    heap = max(min(int(free * heap_share), max_heap_mb), 256)
+    cpus = max(facts['cpus'], 1)
+    if heap >= 4096:
+        # G1 keeps pauses short on big heaps
+        gc = ['-XX:+UseG1GC', '-XX:MaxGCPauseMillis=250', '-XX:+ParallelRefProcEnabled']
+    else:
+        gc = ['-XX:+UseConcMarkSweepGC', '-XX:+UseParNewGC', '-XX:CMSInitiatingOccupancyFraction=70',
+              '-XX:+UseCMSInitiatingOccupancyOnly', '-XX:+CMSParallelRemarkEnabled']
+    gc.append('-XX:ParallelGCThreads=%d' % cpus)
+    return OrderedDict([
+        # a fixed-size heap never stalls to grow or shrink
+        ('heap',          ['-Xms%dm' % heap, '-Xmx%dm' % heap]),
+        ('gc',            gc),
+        ('direct_memory', ['-XX:MaxDirectMemorySize=%dm' % max(min(free - heap, heap) / 4, 64)]),
+    ])
+
+
+def solr_plan(index_mb, docs, nodes, cache_mb, shard_max_mb=10240, shard_max_docs=20000000):
+    """Shard and replica counts for a collection, and which node gets each replica.
+
+    Shards keep each core under a size and document count that stay quick to
+    search and to recover. Replicas go as wide as the nodes' page cache can hold,
+    since every extra copy is another box answering queries."""
+    shards = max(int(math.ceil(float(index_mb) / shard_max_mb)), int(math.ceil(float(docs) / shard_max_docs)), 1)
+    replicas = 1
+    for r in range(len(nodes), 0, -1):
+        if float(index_mb) * r / len(nodes) <= cache_mb:
+            replicas = r
+            break
+    per_node = int(math.ceil(float(shards * replicas) / len(nodes)))
+    placement = OrderedDict()
+    for s in range(shards):
+        placement['shard%d' % (s + 1)] = [nodes[(s + r) % len(nodes)] for r in range(replicas)]
+    return {
+        'shards'             : shards,
+        'replicas'           : replicas,
+        'max_shards_per_node': per_node,
+        'placement'          : placement,
+        # the index won't fit in the page cache even with a single copy of each shard
+        'cache_bound'        : float(index_mb) / len(nodes) > cache_mb,
+    }
+
+
+def zookeeper_timing(rtts_ms, tick=2000):
+    """tickTime, initLimit and syncLimit from the slowest round-trip between ensemble members.
+
+    A follower is dropped once it falls syncLimit ticks behind, so that window has
+    to be a comfortable multiple of the slowest link; initLimit also has to cover
+    pulling a snapshot when a follower (re)joins."""
+    worst = float(max(rtts_ms or [0]))
+    # slow links get a coarser tick rather than ever more ticks
+    tick = max(tick, int(math.ceil(worst * 10 / 500.0)) * 500)
+    sync = max(2, int(math.ceil(worst * 50 / tick)))
+    return OrderedDict([
+        ('tickTime',  tick),
+        ('initLimit', max(10, sync * 5)),
+        ('syncLimit', sync),
+    ])
+
+
+def zookeeper_heap(facts):
+    """ZooKeeper keeps its whole tree in memory, but SolrCloud's tree is small"""
+    return min(max(facts['memory_mb'] / 32, 256), 2048)
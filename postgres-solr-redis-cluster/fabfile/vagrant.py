@@ -6,6 +6,8 @@ Vagrant-specific tooling
 Created by: Rui Carmo
 """
 
+from fabric.api import env, local, hide
+
 def vagrant():
     """Allow fabric to manage a Vagrant VM/LXC container"""
     env.user = 'vagrant'
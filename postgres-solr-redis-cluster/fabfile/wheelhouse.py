@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Python wheelhouse
+
+Builds wheels for the pinned packages in config.packages['pip'] once, on a single
+build box (the master by default, since it has the same distribution, Python and
+headers as the rest), and ships them through the artifact cache. Every box then
+installs them into a virtualenv with `--no-index`, so nothing is compiled or
+downloaded from PyPI more than once and only the build box needs the proxy.
+
+The set of pins is hashed into a lock, which is recorded in the virtualenv after
+a successful install; boxes whose lock matches are left alone.
+"""
+
+import os, json, tempfile
+from hashlib import sha1
+from fabric.api import env, hide, settings, abort, execute
+from fabric.operations import sudo, get
+from .batch import Batch
+from .debian import install_packages
+from .artifacts import add_artifact, local_path, remote_path, spread_artifacts
+from .config import state_dir, load_json, save_json, packages, wheelhouse, artifacts as artifact_settings
+
+index_file = os.path.join(state_dir, 'wheelhouse.json')
+lock_file  = wheelhouse['virtualenv'] + '/.lock'
+
+
+def requirements():
+    return '\n'.join(sorted(packages['pip'])) + '\n'
+
+
+def lock_hash():
+    """Identifies a set of pins (and the pip used to install them)"""
+    return sha1(json.dumps([requirements(), wheelhouse['pip']])).hexdigest()[:16]
+
+
+def load_index():
+    return load_json(index_file, {})
+
+
+def save_index(index):
+    save_json(index_file, index)
+
+
+def build_wheels(lock):
+    """Build every wheel on the current host and bring the packed wheelhouse back to the controller cache"""
+    install_packages(['postgres', 'python'])
+    build = '/tmp/wheelhouse-%s' % lock
+    pip = '%s/env/bin/pip' % build
+    proxy = artifact_settings.get('proxy')
+    # the build box is the only one that talks to PyPI
+    if proxy:
+        pip = 'http_proxy=%s https_proxy=%s %s' % (proxy, proxy, pip)
+    with Batch() as b:
+        b.sudo('rm -rf %s && mkdir -p %s/wheels && virtualenv -q %s/env' % (build, build, build))
+        b.sudo('%s install -q %s %s' % (pip, wheelhouse['pip'], wheelhouse['wheel']))
+        b.put(requirements(), '%s/wheels/requirements.txt' % build)
+        # targets bootstrap a wheel-capable pip from its sdist, since the one virtualenv bundles is too old
+        b.sudo('%s install -q --download %s/wheels %s' % (pip, build, wheelhouse['pip']))
+        b.sudo('%s wheel -q -w %s/wheels -r %s/wheels/requirements.txt' % (pip, build, build))
+        b.sudo('tar -czf %s/wheelhouse.tgz -C %s/wheels .' % (build, build))
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    with hide('running'):
+        get('%s/wheelhouse.tgz' % build, path, use_sudo=True)
+        sudo('rm -rf %s' % build)
+    return add_artifact(path)
+
+
+def build_wheelhouse(rebuild=False):
+    """Build the wheelhouse for the current pins on the build box (once per lock), and spread it to every box"""
+    lock = lock_hash()
+    index = load_index()
+    checksum = index.get(lock)
+    if not checksum or not os.path.exists(local_path(checksum)) or rebuild in [True, 'True', 'true', '1', 'yes']:
+        builder = wheelhouse['build_host'] or env.roledefs['master'][0]
+        print "Building wheelhouse %s on %s" % (lock, builder)
+        checksum = execute(build_wheels, lock, hosts=[builder])[builder]
+        index[lock] = checksum
+        save_index(index)
+    spread_artifacts([checksum])
+    print "Wheelhouse %s (%s) is on every box" % (lock, checksum[:12])
+    return checksum
+
+
+def install_wheelhouse():
+    """Install the pinned packages into the virtualenv from the shipped wheelhouse, unless the lock already matches"""
+    lock = lock_hash()
+    checksum = load_index().get(lock)
+    if not checksum:
+        abort("no wheelhouse built for lock %s, run build_wheelhouse first" % lock)
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        if sudo('cat %s' % lock_file).strip() == lock:
+            print "[%s] virtualenv already at lock %s" % (env.host, lock)
+            return False
+    venv = wheelhouse['virtualenv']
+    unpacked = '/tmp/wheelhouse-%s' % lock
+    pip = '%s/bin/pip install -q --no-index --find-links=%s' % (venv, unpacked)
+    with Batch() as b:
+        b.sudo('rm -rf %s && mkdir -p %s && tar -xzf %s -C %s' % (unpacked, unpacked, remote_path(checksum), unpacked))
+        b.sudo('virtualenv -q --never-download %s' % venv, unless='[ -x %s/bin/python ]' % venv)
+        b.sudo('%s %s' % (pip, wheelhouse['pip']))
+        b.sudo('%s -r %s/requirements.txt' % (pip, unpacked))
+        b.sudo('echo %s > %s && rm -rf %s' % (lock, lock_file, unpacked))
+    print "[%s] virtualenv %s now at lock %s" % (env.host, venv, lock)
+    return True
@@ -7,12 +7,19 @@ Created by: Rui Carmo
 """
 
 import os, sys
+from collections import OrderedDict
 from StringIO import StringIO
-from fabric.api import env, local, hosts, roles
+from fabric.api import env, local, hosts, roles, cd
 from fabric.operations import run, sudo, put, hide, settings
-from fabric.contrib.files import contains, exists, cd, append, comment, uncomment
+from fabric.contrib.files import contains, exists, append, comment, uncomment
 from .helpers import tarball, collect_ip_addresses
-from .config import tarballs
+from .batch import Batch
+from .facts import get_facts, save_latency, measured_latency
+from .tuning import zookeeper_timing, zookeeper_heap
+from .managed import render, sync_configs, changed_settings
+from .handlers import notify, forget
+from .rollout import fan_out
+from .config import tarballs, zookeeper
 
 init_file     = '/etc/init.d/zookeeper'
 defaults_file = '/etc/default/zookeeper'
@@ -20,6 +27,7 @@ config_dir    = '/etc/zookeeper'
 config_file   = config_dir + '/zoo.cfg'
 data_dir      = '/srv/data/zookeeper'
 log_dir       = '/var/log/zookeeper'
+data_log_dir  = zookeeper['data_log_dir']
 
 
 def unpack_zookeeper():
@@ -30,69 +38,149 @@ def unpack_zookeeper():
         sudo('ln -s /srv/zookeeper-3.4.5 /srv/zookeeper')
 
 
-def setup_zookeeper_service():
-    """Set up the Zookeeper service and configure it for the cluster"""
-    
-    if not exists(config_dir):
-        sudo('mkdir -p ' + config_dir)
-        sudo('chown root:root ' + config_dir)
-
-    for d in [data_dir, log_dir]:
-        if not exists(d):
-            sudo('mkdir -p ' + d)
-            sudo('chown -R www-data:www-data ' + d)
+def ensemble(intf='eth0'):
+    """(id, address) pairs for the ensemble the current host belongs to"""
+    if env.host in env.roledefs['production']:
+        return [(i + 1, env.addresses[h][intf]) for i, h in enumerate(env.roledefs['production'])]
+    return [(1, '127.0.0.1')]
+
+
+def myid():
+    if env.host in env.roledefs['production']:
+        return env.roledefs['production'].index(env.host) + 1
+    return 1
+
+
+def timing():
+    """Tick and limits from the round-trips measured between the boxes (LAN defaults until first measured)"""
+    rtts = [ms for peers in measured_latency().values() for ms in peers.values()]
+    return zookeeper_timing(rtts)
+
+
+def heap_mb():
+    return zookeeper['heap_mb'] or zookeeper_heap(get_facts())
+
+
+def zookeeper_config():
+    """Render the full zoo.cfg, with one line per ensemble member"""
+    conf = timing()
+    conf.update([
+        ('dataDir',                  data_dir),
+        # the transaction log is fsynced on every write, so it gets its own directory (ideally its own disk)
+        ('dataLogDir',               data_log_dir),
+        ('clientPort',               zookeeper['client_port']),
+        ('maxClientCnxns',           zookeeper['max_client_cnxns']),
+        ('autopurge.snapRetainCount', zookeeper['snap_retain_count']),
+        ('autopurge.purgeInterval',  zookeeper['purge_interval_h']),
+    ])
+    for i, address in ensemble():
+        conf['server.%d' % i] = '%s:2888:3888' % address
+    return render(conf)
+
+
+def zookeeper_defaults():
+    heap = heap_mb()
+    return render(OrderedDict([
+        ('ZOOKEEPER_ENABLED', 'true'),
+        ('ZOOKEEPER_USER',    'www-data'),
+        ('ZOOCFG',            config_file),
+        ('ZOOKEEPER_PREFIX',  '/srv/zookeeper'),
+        ('ZOO_LOG_DIR',       log_dir),
+        ('JVMFLAGS',          '"-Xms%dm -Xmx%dm -XX:+HeapDumpOnOutOfMemoryError"' % (heap, heap)),
+    ]))
+
+
+@roles('production')
+def measure_latency(intf='eth0', count=10):
+    """Average round-trip (ms) from the current host to each other ensemble member"""
+    collect_ip_addresses(intf)
+    peers = [h for h in env.roledefs['production'] if h != env.host]
+    with hide('running', 'output'):
+        b = Batch()
+        for peer in peers:
+            b.sudo('ping -c %d -i 0.2 -q %s | tail -1' % (int(count), env.addresses[peer][intf]), warn_only=True)
+        results = b.execute()
+    latency = {}
+    for peer, out in zip(peers, results):
+        # rtt min/avg/max/mdev = 0.211/0.302/0.419/0.061 ms
+        if out.succeeded and '=' in out:
+            latency[peer] = float(out.split('=')[1].strip().split('/')[1])
+    print "[%s] round-trips: %s" % (env.host, ', '.join('%s %.2fms' % i for i in sorted(latency.items())))
+    save_latency(env.host, latency)
+    return latency
 
-    if not exists(init_file):
-        put(StringIO(zookeeper_init), init_file, use_sudo=True)
-        sudo('chmod +x ' + init_file)
-        sudo('chown root:root ' + init_file)
 
-    if not exists(config_file):
-        put(StringIO(zookeeper_config), config_file, use_sudo=True)
+def setup_zookeeper_service():
+    """Set up the Zookeeper service and configure it for the cluster"""
 
-    if not exists(defaults_file):
-        put(StringIO(zookeeper_defaults), defaults_file, use_sudo=True)
+    with Batch() as b:
+        b.sudo('mkdir -p %s && chown root:root %s' % (config_dir, config_dir), unless='[ -e %s ]' % config_dir)
+        for d in [data_dir, data_log_dir, log_dir]:
+            b.sudo('mkdir -p %s && chown -R www-data:www-data %s' % (d, d), unless='[ -e %s ]' % d)
 
-    append(config_file, 'initLimit=5', use_sudo=True)
-    append(config_file, 'syncLimit=2', use_sudo=True)
+    conf = zookeeper_config()
+    moved = 'dataLogDir' in changed_settings(config_file, conf)
     # production machines need to know about each other and have an ID file
-    if 'production' in env.roles:
-        i = 1
-        for h in env.roledefs['production']:
-            i = i + 1
-
-            append(config_file, 'dataDir=/srv/data/zookeeper/%d' % i, use_sudo=True)
-            append(config_file, 'server.%d=%s:2888:3888' % (i, env.addresses[h]), use_sudo=True)
-        # now create the ID file
-        put(StringIO(str(env.roledefs['production'].index(env.host))), "%s/myid" % data_dir, use_sudo=True)
-    else:
-        append(config_file, 'dataDir=/srv/data/zookeeper/1', use_sudo=True)
-        append(config_file, 'server.1=127.0.0.1:2888:3888', use_sudo=True)
-        put(StringIO("1"), "%s/myid" % data_dir, use_sudo=True)
-
-
+    changed = sync_configs([
+        (init_file,              zookeeper_init,       'root:root',         '0755'),
+        (defaults_file,          zookeeper_defaults(), 'root:root',         '0644'),
+        (config_file,            conf,                 'root:root',         '0644'),
+        ('%s/myid' % data_dir,   '%d\n' % myid(),     'www-data:www-data', '0644'),
+    ])
+    # only now is the init script there to register
     sudo('update-rc.d zookeeper defaults')
-    sudo('service zookeeper restart')
-
-
-zookeeper_config = """
-tickTime=2000
-clientPort=2181
-"""
-
-zookeeper_defaults = """
-# comment this line to disable
-ZOOKEEPER_ENABLED=false
-
-ZOOKEEPER_USER=www-data
-
-ZOOCFG=/etc/zookeeper/zoo.cfg
-
-ZOOKEEPER_PREFIX=/srv/zookeeper
-
-ZOO_LOG_DIR=/var/log/zookeeper
-#JVMFLAGS=
-"""
+    if moved:
+        # logs written so far still sit next to the snapshots, and the server must find them on restart
+        with Batch() as b:
+            b.sudo('service zookeeper stop', warn_only=True)
+            b.sudo('mkdir -p %s/version-2 && (mv %s/version-2/log.* %s/version-2/ 2>/dev/null; true) && chown -R www-data:www-data %s' % (
+                data_log_dir, data_dir, data_log_dir, data_log_dir))
+            b.sudo('service zookeeper start')
+        forget('zookeeper')
+        print "[%s] zookeeper: moved the transaction log to %s" % (env.host, data_log_dir)
+    elif changed:
+        notify('zookeeper')
+
+
+def mntr():
+    """The current host's `mntr` stats, or None if the server isn't answering"""
+    with settings(hide('running', 'output', 'warnings'), warn_only=True):
+        out = sudo('echo mntr | nc -q 2 localhost %d' % zookeeper['client_port'])
+    stats = dict(l.split('\t', 1) for l in out.replace('\r', '').splitlines() if '\t' in l)
+    return stats or None
+
+
+@roles('production')
+def zookeeper_mntr():
+    return mntr()
+
+
+def zookeeper_health():
+    """Check every ensemble member with `mntr`: one leader, followers in sync, and request latency"""
+    results = fan_out(zookeeper_mntr, 'production')
+    problems = []
+    leaders = [h for h, r in results.items() if isinstance(r, dict) and r.get('zk_server_state') == 'leader']
+    print "\nZooKeeper ensemble"
+    for host in sorted(results):
+        r = results[host]
+        if not isinstance(r, dict):
+            problems.append('%s not answering' % host)
+            print "  %-20s %s" % (host, r or 'not answering')
+            continue
+        print "  %-20s %-9s latency min/avg/max %s/%s/%s ms, %s outstanding, %s znodes, %s connections" % (
+            host, r.get('zk_server_state'), r.get('zk_min_latency'), r.get('zk_avg_latency'), r.get('zk_max_latency'),
+            r.get('zk_outstanding_requests'), r.get('zk_znode_count'), r.get('zk_num_alive_connections'))
+        if int(r.get('zk_avg_latency', 0)) > zookeeper['max_avg_latency']:
+            problems.append('%s average latency %sms' % (host, r['zk_avg_latency']))
+        if int(r.get('zk_outstanding_requests', 0)) > 10:
+            problems.append('%s has %s requests queued' % (host, r['zk_outstanding_requests']))
+        if r.get('zk_server_state') == 'leader' and r.get('zk_synced_followers') != r.get('zk_followers'):
+            problems.append('only %s of %s followers in sync' % (r.get('zk_synced_followers'), r.get('zk_followers')))
+    if len(leaders) != 1 and len(results) > 1:
+        problems.append('%d leaders' % len(leaders))
+    for problem in problems:
+        print "  !! %s" % problem
+    return problems
 
 
 zookeeper_init = """#! /bin/sh
@@ -120,6 +208,7 @@ export ZOOPIDFILE=${ZOODATADIR}/zookeeper_server.pid
 
 # stupid hack to workaround the release's buggy startup scripts
 export ZOO_LOG_DIR=${ZOO_LOG_DIR}
+export JVMFLAGS
 cd ${ZOO_LOG_DIR}
 
 test -x $JAVA || exit 0